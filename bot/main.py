@@ -7,6 +7,17 @@ from aiogram.client.session.aiohttp import AiohttpSession
 
 from config import load_env
 from src.utils.db import db
+from src.utils.broadcast import watch_mailings
+from src.utils.indexes import ensure_indexes
+from src.utils.channel_registry import migrate_channel_members
+from src.utils.write_behind import user_updates
+from src.utils.counters import adv_counters, referral_clicks
+from src.utils.adv_delivery import adv_delivery
+from src.utils.tracking import referral_attribution, referral_events
+from src.utils.referral_routing import referral_router
+from src.utils.rollups import referral_rollups
+from src.utils.redis_cache import init_redis, redis_cache
+from src.utils.invalidation import invalidation_bus
 
 from src.handlers import router as main_router
 from src.middlewares.db_middleware import DataBaseMiddleware
@@ -18,6 +29,17 @@ load_env()
 
 
 async def main():
+    # One Redis connection pool for the whole process
+    await init_redis()
+    # Drop local caches when other bot processes change shared data
+    invalidation_bus.start()
+    # Build missing indexes before handling any updates
+    await ensure_indexes(db)
+    # Move legacy subscribed_users arrays into the channel_members collection
+    await migrate_channel_members(db)
+    # Referral ids: environment defaults, replaced by the settings document when it exists
+    await referral_router.start(db)
+
     session = AiohttpSession()
     bot_settings = {"session": session, "parse_mode": "HTML"}
     bot = Bot(token=os.getenv("BOT_TOKEN"), **bot_settings)
@@ -33,7 +55,31 @@ async def main():
 
     dp.include_router(main_router)
 
-    await dp.start_polling(bot)
+    # Continue mailings interrupted by a restart or abandoned by another process
+    mailing_watcher = asyncio.create_task(watch_mailings(bot, db))
+
+    user_updates.start()
+    adv_counters.start()
+    referral_clicks.start()
+    adv_delivery.start()
+    referral_attribution.start()
+    referral_events.start()
+    referral_rollups.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        mailing_watcher.cancel()
+        # Finish queued adverts, then flush buffered updates so nothing is lost on shutdown
+        await adv_delivery.close()
+        await user_updates.close()
+        await adv_counters.close()
+        await referral_clicks.close()
+        await referral_attribution.close()
+        await referral_events.close()
+        await referral_rollups.close()
+        await referral_router.close()
+        await invalidation_bus.close()
+        await redis_cache.close()
 
 
 if __name__ == '__main__':
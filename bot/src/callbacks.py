@@ -92,6 +92,10 @@ class ReferralSelect(CallbackData, prefix='referral_select'):
     id: str
 
 
+class ReferralReport(CallbackData, prefix='referral_report'):
+    period: str = 'day'
+
+
 class AddAdv(CallbackData, prefix='add_adv'):
     ...
 
@@ -108,6 +112,10 @@ class AdvEdit(CallbackData, prefix='adv_edit'):
     adv_id: int
 
 
+class AdvStatsView(CallbackData, prefix='adv_stats'):
+    adv_id: int
+
+
 class AdvMediaEdit(CallbackData, prefix='adv_edit_media'):
     adv_id: int
 
@@ -2,10 +2,12 @@ from aiogram import Bot, Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from src.callbacks import AdminAdv, AddAdv, AdvNav, AdvRemove, AdvEdit, AdvTextEdit, AdvMediaEdit
+from src.callbacks import AdminAdv, AddAdv, AdvNav, AdvRemove, AdvEdit, AdvTextEdit, AdvMediaEdit, AdvStatsView
 from src.utils.db import MongoDbClient
+from src.utils.adv_catalog import adv_catalog
+from src.utils.counters import get_adv_impressions
 from src.utils.fsm_state import SendAdv, EditText, EditMedia
-from src.utils.functions.admin.function import send_no_adv_message, send_media, create_keyboard
+from src.utils.functions.admin.function import send_no_adv_message, send_media, create_keyboard, adv_stats_button
 
 router = Router()
 
@@ -14,19 +16,20 @@ router = Router()
 @router.callback_query(AdminAdv.filter())
 async def admin_adv_initial(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient):
     await callback_query.answer('Реклама')  # Send a response to the callback query
-    adv_query = await db.adv.find_one_with_min_adv_id()  # Find the advertisement post with the minimum ID
+    adv_index = await adv_catalog.get(db)  # Advertisement posts ordered by ID (kept in memory)
+    adv_query = adv_index.first()  # Find the advertisement post with the minimum ID
     if not adv_query:
         await send_no_adv_message(bot,
                                   callback_query)  # If the post is not found
         return
 
     kwargs = {'caption': adv_query.caption} if adv_query.caption else {}  # If the post has a caption, add it to kwargs
-    next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)  # Find the next advertisement post
+    next_adv_query = adv_index.next(adv_query.adv_id)  # Find the next advertisement post
     builder = InlineKeyboardBuilder()  # Create a builder for the inline keyboard
+    builder.row(adv_stats_button(adv_query.adv_id, await get_adv_impressions(db, adv_query.adv_id)))  # Impressions
     builder.row(InlineKeyboardButton(text='Редактировать пост', callback_data=AdvEdit(
         adv_id=int(adv_query.adv_id)).pack()))  # Add "Edit Post" button
-    adv_quantity = await db.adv.count({})  # Count the number of advertisement posts
-    if adv_quantity > 1:
+    if next_adv_query:
         builder.add(InlineKeyboardButton(text='Следующий', callback_data=AdvNav(
             index=next_adv_query.adv_id).pack()))  # If there are more than one post, add "Next" button
     builder.row(InlineKeyboardButton(text='Добавить пост', callback_data=AddAdv().pack()))  # Add "Add Post" button
@@ -52,7 +55,8 @@ async def add_adv(callback_query: CallbackQuery, bot: Bot, state: FSMContext):
 async def admin_adv_navigation(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient, callback_data: AdvNav):
     await callback_query.answer('Реклама')  # Send a response to the callback query
     current_adv_id = callback_data.index  # Get the current advertisement ID
-    adv_query = await db.adv.find_one({'adv_id': int(current_adv_id)})  # Find the advertisement post by ID
+    adv_index = await adv_catalog.get(db)  # Advertisement posts ordered by ID (kept in memory)
+    adv_query = adv_index.get(int(current_adv_id))  # Find the advertisement post by ID
     if not adv_query:
         await bot.send_message(callback_query.from_user.id,
                                text='Рекламные посты не найдены.')  # If the post is not found, send a message
@@ -62,7 +66,8 @@ async def admin_adv_navigation(callback_query: CallbackQuery, bot: Bot, db: Mong
     builder = InlineKeyboardBuilder()  # Create a builder for the inline keyboard
 
     # Find the previous advertisement post
-    prev_adv_query = await db.adv.find_one_with_prev_adv_id(current_adv_id)
+    prev_adv_query = adv_index.prev(current_adv_id)
+    builder.row(adv_stats_button(adv_query.adv_id, await get_adv_impressions(db, adv_query.adv_id)))  # Impressions
     builder.row(InlineKeyboardButton(text='Редактировать пост', callback_data=AdvEdit(
         adv_id=int(adv_query.adv_id)).pack()))  # Add "Edit Post" button
 
@@ -73,7 +78,7 @@ async def admin_adv_navigation(callback_query: CallbackQuery, bot: Bot, db: Mong
         pass
 
     # Find the next advertisement post
-    next_adv_query = await db.adv.find_one_with_next_adv_id(current_adv_id)
+    next_adv_query = adv_index.next(current_adv_id)
     if next_adv_query:
         builder.add(InlineKeyboardButton(text='Следующий', callback_data=AdvNav(
             index=next_adv_query.adv_id).pack()))  # If the next post is found, add "Next" button
@@ -91,7 +96,8 @@ async def admin_adv_navigation(callback_query: CallbackQuery, bot: Bot, db: Mong
 async def admin_adv_remove(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient, callback_data: AdvRemove):
     await callback_query.answer('Удалить')  # Send a response to the callback query
     await db.adv.delete_one({'adv_id': int(callback_data.adv_id)})  # Delete the advertisement post from the database
-    adv_query = await db.adv.find_one_with_min_adv_id()  # Find the advertisement post with the minimum ID
+    adv_index = await adv_catalog.get(db)  # The catalog reloads after the deletion
+    adv_query = adv_index.first()  # Find the advertisement post with the minimum ID
     if not adv_query:
         await send_no_adv_message(bot,
                                   callback_query)  # If the post is not found, send a message indicating no advertisements
@@ -100,14 +106,22 @@ async def admin_adv_remove(callback_query: CallbackQuery, bot: Bot, db: MongoDbC
     kwargs = {'caption': adv_query.caption} if adv_query.caption else {}  # If the post has a caption, add it to kwargs
     await bot.delete_message(chat_id=callback_query.from_user.id,
                              message_id=callback_query.message.message_id)  # Delete the message with the advertisement post
-    next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)  # Find the next advertisement post
-    adv_quantity = await db.adv.count({})  # Count the number of advertisement posts
-    builder = create_keyboard(adv_query, next_adv_query,
-                              adv_quantity)  # Create the keyboard for navigating through advertisement posts
+    next_adv_query = adv_index.next(adv_query.adv_id)  # Find the next advertisement post
+    adv_quantity = len(adv_index)  # Count the number of advertisement posts
+    impressions = await get_adv_impressions(db, adv_query.adv_id)  # Impressions of the post
+    builder = create_keyboard(adv_query, next_adv_query, adv_quantity,
+                              impressions)  # Create the keyboard for navigating through advertisement posts
     await send_media(bot, callback_query, adv_query, builder,
                      **kwargs)  # Send the media with the advertisement post and keyboard
 
 
+# Callback for showing up-to-date impressions of an advertisement post
+@router.callback_query(AdvStatsView.filter())
+async def admin_adv_stats(callback_query: CallbackQuery, db: MongoDbClient, callback_data: AdvStatsView):
+    total, today = await get_adv_impressions(db, callback_data.adv_id)  # Persisted counters plus not yet flushed ones
+    await callback_query.answer(f'Показы поста: {total}\nСегодня: {today}', show_alert=True)
+
+
 # Callback for choosing to edit an advertisement post
 @router.callback_query(AdvEdit.filter())
 async def adv_edit_choose(callback_query: CallbackQuery, callback_data: AdvEdit, bot: Bot):
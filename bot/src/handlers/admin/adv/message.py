@@ -3,6 +3,8 @@ from aiogram import Bot, Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 from src.utils.db import MongoDbClient
+from src.utils.adv_catalog import adv_catalog, next_adv_id
+from src.utils.counters import get_adv_impressions
 from src.utils.fsm_state import SendAdv, EditMedia, EditText
 from src.utils.functions.admin.function import send_no_adv_message, \
     create_keyboard, handle_media, send_adv_message, update_adv_data
@@ -21,38 +23,37 @@ async def send_adv(message: Message, bot: Bot, state: FSMContext, db: MongoDbCli
 
     # Handle media content in the message
     content, content_type = await handle_media(message)
-    # Find the document with the maximum advertisement ID
-    max_adv_document = await db.adv.find_one_with_max_adv_id()
-    max_adv_id = max_adv_document.adv_id if max_adv_document else 0
     # Create a dictionary with the message data
     message_data = {
         'date': time.time(),
         'content': content,
         'content_type': content_type,
         'caption': message.caption,
-        'adv_id': int(max_adv_id) + 1
+        # The ID comes from an atomic sequence, so concurrent additions never collide
+        'adv_id': await next_adv_id(db)
     }
 
-    # Insert the message data into the database
+    # Insert the message data into the database (the adv catalog reloads after the change)
     await db.adv.insert_one(message_data)
     # Clear the state
     await state.clear()
-    # Find the document with the minimum advertisement ID
-    adv_query = await db.adv.find_one_with_min_adv_id()
+    adv_index = await adv_catalog.get(db)
+    # Find the advertisement with the minimum ID
+    adv_query = adv_index.first()
     if not adv_query:
         await bot.send_message(message.from_user.id, text='Рекламные посты не найдены')
         return
 
     # Create a dictionary with the caption if it exists
     kwargs = {'caption': adv_query.caption} if adv_query.caption else {}
-    # Find the document with the next advertisement ID
-    next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)
-    # Count the number of advertisements in the database
-    adv_quantity = await db.adv.count({})
+    # Find the advertisement with the next ID
+    next_adv_query = adv_index.next(adv_query.adv_id)
+    # Count the number of advertisements
+    adv_quantity = len(adv_index)
     if adv_quantity == 1:
         await bot.delete_message(chat_id=message.from_user.id, message_id=int(data.get('main_message_id')))
-    # Create a keyboard for the advertisement
-    builder = create_keyboard(adv_query, next_adv_query, adv_quantity)
+    # Create a keyboard for the advertisement with its impressions
+    builder = create_keyboard(adv_query, next_adv_query, adv_quantity, await get_adv_impressions(db, adv_query.adv_id))
     # Send the media message with the advertisement
     await send_adv_message(bot, message, adv_query, builder, data.get('main_message_id'), **kwargs)
 
@@ -72,20 +73,21 @@ async def edit_media_adv(message: Message, bot: Bot, state: FSMContext, db: Mong
     # Update the advertisement in the database
     await update_adv_data(db, data.get('adv_id'), message_data)
 
-    # Find the advertisement in the database
-    adv_query = await db.adv.find_one(({'adv_id': int(data.get('adv_id'))}))
+    # Find the advertisement in the catalog
+    adv_index = await adv_catalog.get(db)
+    adv_query = adv_index.get(int(data.get('adv_id')))
     if not adv_query:
         await send_no_adv_message(bot, message)
         return
 
     # Create a dictionary with the caption if it exists
     kwargs = {'caption': adv_query.caption} if adv_query.caption else {}
-    # Find the document with the next advertisement ID
-    next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)
-    # Count the number of advertisements in the database
-    adv_quantity = await db.adv.count({})
-    # Create a keyboard for the advertisement
-    builder = create_keyboard(adv_query, next_adv_query, adv_quantity)
+    # Find the advertisement with the next ID
+    next_adv_query = adv_index.next(adv_query.adv_id)
+    # Count the number of advertisements
+    adv_quantity = len(adv_index)
+    # Create a keyboard for the advertisement with its impressions
+    builder = create_keyboard(adv_query, next_adv_query, adv_quantity, await get_adv_impressions(db, adv_query.adv_id))
     # Send the media message with the advertisement
     await send_adv_message(bot, message, adv_query, builder, data.get('main_message_id'), **kwargs)
 
@@ -101,19 +103,20 @@ async def edit_text_adv(message: Message, bot: Bot, state: FSMContext, db: Mongo
     # Update the advertisement in the database with the new text
     await update_adv_data(db, data.get('adv_id'), {'caption': message.text})
 
-    # Find the advertisement in the database
-    adv_query = await db.adv.find_one(({'adv_id': int(data.get('adv_id'))}))
+    # Find the advertisement in the catalog
+    adv_index = await adv_catalog.get(db)
+    adv_query = adv_index.get(int(data.get('adv_id')))
     if not adv_query:
         await send_no_adv_message(bot, message)
         return
 
     # Create a dictionary with the caption if it exists
     kwargs = {'caption': adv_query.caption} if adv_query.caption else {}
-    # Find the document with the next advertisement ID
-    next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)
-    # Count the number of advertisements in the database
-    adv_quantity = await db.adv.count({})
-    # Create a keyboard for the advertisement
-    builder = create_keyboard(adv_query, next_adv_query, adv_quantity)
+    # Find the advertisement with the next ID
+    next_adv_query = adv_index.next(adv_query.adv_id)
+    # Count the number of advertisements
+    adv_quantity = len(adv_index)
+    # Create a keyboard for the advertisement with its impressions
+    builder = create_keyboard(adv_query, next_adv_query, adv_quantity, await get_adv_impressions(db, adv_query.adv_id))
     # Send the media message with the advertisement
     await send_adv_message(bot, message, adv_query, builder, data.get('main_message_id'), **kwargs)
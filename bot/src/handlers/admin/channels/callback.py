@@ -4,6 +4,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from src.callbacks import AdminChannels, AddSponsor, RemoveSponsor, SponsorList, ChannelSelect, AdminPanel
+from src.utils.channel_registry import channel_registry
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import EditSponsorFSM, AddSponsorFSM
 from src.utils.functions.admin.function import build_keyboard, edit_message
@@ -17,9 +18,7 @@ async def admin_panel(callback_query: CallbackQuery, db: MongoDbClient, bot: Bot
     # Retrieve all channels from the database
     await callback_query.answer('Channels')  # Send a response to the callback query
 
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
+    channels_list = await channel_registry.get(db)
     markup = InlineKeyboardBuilder()
     await callback_query.answer('Каналы')
 
@@ -76,7 +75,7 @@ async def channels_admin(callback_query: CallbackQuery, callback_data: AddSponso
     elif callback_data.edit == 'id':
         res = await bot.edit_message_text(chat_id=callback_query.from_user.id, text='Введите ID канала:',
                                           message_id=callback_query.message.message_id)
-        await state.set_state(EditSponsorFSM.edit_channel_id)
+        await state.set_state(EditSponsorFSM.edit_chanel_id)
     elif callback_data.edit == 'url':
         res = await bot.edit_message_text(chat_id=callback_query.from_user.id, text='Введите URL:',
                                           message_id=callback_query.message.message_id)
@@ -97,10 +96,8 @@ async def channels_admin(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
     await callback_query.answer('Назад')  # Send a response to the callback query
 
     # Retrieve all channels from the database
-    channels = await db.channels.find({})
+    channels_list = await channel_registry.get(db)
     await callback_query.answer('Back')
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
     markup = InlineKeyboardBuilder()
     # Add each channel to the inline keyboard
     for channel in channels_list:
@@ -125,10 +122,10 @@ async def remove_sponsor(callback_query: CallbackQuery, bot: Bot, callback_data:
 
     # Delete the selected channel from the database
     await db.channels.delete_one({'channel_id': callback_data.channel_id})
+    await db.channel_members.delete_many({'channel_id': callback_data.channel_id})
+    channel_registry.invalidate()
     # Retrieve all channels from the database
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
+    channels_list = await channel_registry.get(db)
     markup = InlineKeyboardBuilder()
     # Add each channel to the inline keyboard
     for channel in channels_list:
@@ -2,8 +2,10 @@ from aiogram import Bot, Router
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardButton, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from pymongo.errors import DuplicateKeyError
 
 from src.callbacks import AddSponsor, ChannelSelect, AdminPanel
+from src.utils.channel_registry import channel_registry, move_channel_members
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import AddSponsorFSM, EditSponsorFSM
 from src.utils.functions.admin.function import update_channel_data, edit_message, build_keyboard
@@ -35,8 +37,18 @@ async def change_channel_id(message: Message, bot: Bot, state: FSMContext, db: M
     await bot.delete_message(chat_id=message.from_user.id, message_id=message.message_id)
     data = await state.get_data()
     # Update the channel's ID in the database
-    await update_channel_data(db, {'channel_id': int(data.get('channel_id'))},
-                              {'channel_id': int(message.text)})
+    if not await update_channel_data(db, {'channel_id': int(data.get('channel_id'))},
+                                     {'channel_id': int(message.text)}):
+        # The ID belongs to another sponsor (or the channel is gone), nothing is moved
+        await edit_message(bot, message.from_user.id, int(data.get('message_id')),
+                           f'❗️ Не удалось изменить ID: канал {message.text} уже есть в списке спонсоров.\n\n'
+                           f'Sponsor: {data.get("name")}\n\nUrl: {data.get("url")}\n'
+                           f'Channel_id: {data.get("channel_id")}\n\nSubscribed: {data.get("subs")}',
+                           build_keyboard(int(data.get('channel_id'))))
+        await state.clear()
+        return
+    # Move the channel's members to the new ID as well
+    await move_channel_members(db, int(data.get('channel_id')), int(message.text))
     # Build the keyboard for the updated channel
     keyboard = build_keyboard(int(message.text))
     # Edit the message to display the updated channel's information
@@ -95,12 +107,15 @@ async def upload_url(message: Message, bot: Bot, state: FSMContext, db: MongoDbC
     await bot.delete_message(chat_id=message.from_user.id, message_id=message.message_id)
     data = await state.get_data()
     # Insert the new channel into the database
-    await db.channels.insert_one({'channel_id': int(data.get('channel_id')), 'name': str(data.get('name')),
-                                  'url': str(message.text.replace(':', ';'))})
+    try:
+        await db.channels.insert_one({'channel_id': int(data.get('channel_id')), 'name': str(data.get('name')),
+                                      'url': str(message.text.replace(':', ';'))})
+    except DuplicateKeyError:
+        # channel_id is unique, the sponsor has already been added
+        await message.answer(f'❗️ Канал {data.get("channel_id")} уже есть в списке спонсоров.')
+    channel_registry.invalidate()
     # Retrieve all channels from the database
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
+    channels_list = await channel_registry.get(db)
     markup = InlineKeyboardBuilder()
     # Add each channel to the inline keyboard
     for channel in channels_list:
@@ -1,26 +1,55 @@
+from datetime import datetime
+
 from aiogram import Router, Bot
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardButton, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from src.callbacks import AdminMailing, SendMailing, AdminPanel
+from src.utils.broadcast import Broadcast, start_broadcast, create_mailing, active_broadcasts
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import Mailing
 
 router = Router()
 
 
+# Function to render the list of recent mailing jobs with their counters
+async def mailing_jobs_text(db: MongoDbClient, limit: int = 5) -> str:
+    jobs = await db.mailings.find({}, count=limit, sort=[('created_at', -1)])
+    if not jobs:
+        return ''
+    lines = []
+    for job in jobs:
+        # Running jobs of this process have fresher counters than the last checkpoint
+        broadcast = active_broadcasts.get(job.id)
+        if broadcast is not None:
+            job = broadcast.job
+        status = {'running': '🟢', 'failed': '❌'}.get(job.status, '✅')
+        date = datetime.fromtimestamp(job.created_at).strftime('%d.%m %H:%M')
+        lines.append(f'{status} {date}: {job.success + job.failed}/{job.total} '
+                     f'(успешно {job.success}, неудачно {job.failed})')
+    return 'Рассылки:\n' + '\n'.join(lines) + '\n\n'
+
+
 # Handler for starting the mailing process
 @router.callback_query(AdminMailing.filter())
-async def mailing_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def mailing_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot, db: MongoDbClient):
     await callback_query.answer('✉️ Рассылка')
     keyboard = InlineKeyboardBuilder()
+    keyboard.row(InlineKeyboardButton(text='🔄 Обновить', callback_data=AdminMailing().pack()))
     keyboard.row(InlineKeyboardButton(text='Назад', callback_data=AdminPanel().pack()))
+    jobs_text = await mailing_jobs_text(db)
     # Prompt the user to enter the text for the mailing
-    mes = await bot.edit_message_text(chat_id=callback_query.from_user.id, text='Введите текст для рассылки:',
-                                      message_id=callback_query.message.message_id, reply_markup=keyboard.as_markup())
+    try:
+        await bot.edit_message_text(chat_id=callback_query.from_user.id,
+                                    text=f'{jobs_text}Введите текст для рассылки:',
+                                    message_id=callback_query.message.message_id, reply_markup=keyboard.as_markup())
+    except TelegramBadRequest:
+        # Counters have not changed since the last refresh
+        pass
     await state.set_state(Mailing.mailing_send)
-    await state.update_data(message_id=mes.message_id)
+    await state.update_data(message_id=callback_query.message.message_id)
 
 
 # Handler for confirming and sending the mailing to all users
@@ -28,28 +57,12 @@ async def mailing_start(callback_query: CallbackQuery, state: FSMContext, bot: B
 async def send_all_confirm(callback_query: CallbackQuery, db: MongoDbClient,
                            callback_data: SendMailing, bot: Bot):
     await callback_query.answer('✅ Confirm')
-    users = await db.users.find({}, count=1)
-    users_list = [{'id': user.id} for user in users]
-    successful_sends = 0
-    failed_sends = 0
     # Notify the user that the mailing process may take a long time
     mes = await bot.send_message(chat_id=callback_query.from_user.id,
                                  text=f'Пожалуйста, подождите, это может занять много времени...')
-    for user in users_list:
-        try:
-            # Try to send the message to each user
-            await bot.copy_message(chat_id=int(user['id']), from_chat_id=callback_query.from_user.id,
-                                   message_id=int(callback_data.mes_id), parse_mode='html')
-            successful_sends += 1
-        except:
-            failed_sends += 1
-        print(f'Trying to send mailing: {int(successful_sends + failed_sends)} out of {len(users_list)}')
+    # Persist the job so it can be resumed after a restart
+    job = await create_mailing(db, admin_id=callback_query.from_user.id, message_id=int(callback_data.mes_id),
+                               progress_message_id=mes.message_id)
+    # Run the mailing in the background so the handler is not blocked
+    start_broadcast(Broadcast(bot, db, job))
 
-    keyboard = InlineKeyboardBuilder()
-    keyboard.row(InlineKeyboardButton(text='Назад', callback_data=AdminPanel().pack()))
-    await bot.delete_message(chat_id=callback_query.from_user.id, message_id=mes.message_id)
-    # Notify the user of the mailing results
-    await bot.send_message(chat_id=callback_query.from_user.id,
-                           text=f'Рассылка отправлена!\nВсего пользователей: {len(users_list)}\n'
-                                f'Успешно: {successful_sends}\nНеудачно: {failed_sends}',
-                           reply_markup=keyboard.as_markup())
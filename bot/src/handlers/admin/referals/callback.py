@@ -1,15 +1,20 @@
 import logging
+import time
+
 from aiogram import Bot, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from src.callbacks import AdminChannels, AddSponsor, RemoveSponsor, SponsorList, ChannelSelect, AdminPanel, \
-    ReferralSelect, AddReferral, AdminRefs, RemoveReferral
+    ReferralSelect, AddReferral, AdminRefs, RemoveReferral, ReferralReport
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import EditSponsorFSM, AddSponsorFSM
 from src.utils.functions.admin.function import build_keyboard, edit_message, build_keyboard_referrals, \
-    generate_random_string
+    generate_random_string, referral_report_text, referral_report_keyboard
+from src.utils.rollups import referral_rollups, bucket
+from src.utils.counters import referral_clicks_total
 
 router = Router()
 
@@ -29,7 +34,8 @@ async def referrals_list(callback_query: CallbackQuery, db: MongoDbClient, bot:
     for referral in referrals_list:
         builder.row(InlineKeyboardButton(text=referral['id'],
                                          callback_data=ReferralSelect(id=referral['id']).pack()))
-    # Add buttons for adding a new referral and going back to the admin panel
+    # Add buttons for the report, adding a new referral and going back to the admin panel
+    builder.row(InlineKeyboardButton(text='📊 Отчет', callback_data=ReferralReport().pack()))
     builder.row(InlineKeyboardButton(text='Добавить', callback_data=AddReferral().pack()))
     builder.row(InlineKeyboardButton(text='Назад', callback_data=AdminPanel().pack()))
     # Edit the message to display the list of referrals
@@ -48,7 +54,25 @@ async def referrals_select(callback_query: CallbackQuery, callback_data: Referra
     keyboard = build_keyboard_referrals(str(callback_data.id))
     # Edit the message to display the referral's details
     await edit_message(bot, callback_query.from_user.id, callback_query.message.message_id,
-                       f'ID : {info.id}\n\nLink : {info.link}\nClicks : {info.clicks}\n\n', keyboard)
+                       f'ID : {info.id}\n\nLink : {info.link}\nClicks : {referral_clicks_total(info)}\n\n', keyboard)
+
+
+# Handler for the referral report (reads only the hourly or daily rollups)
+@router.callback_query(ReferralReport.filter())
+async def referrals_report(callback_query: CallbackQuery, callback_data: ReferralReport, bot: Bot):
+    await callback_query.answer('Отчет')
+    period = 'hour' if callback_data.period == 'hour' else 'day'
+    # Last 24 hours or last 7 days, including the current one
+    since = bucket(period, time.time() - (23 * 3600 if period == 'hour' else 6 * 86400))
+    # Events still buffered in memory are included
+    await referral_rollups.flush()
+    rollups = await referral_rollups.report(period, since)
+    try:
+        await edit_message(bot, callback_query.from_user.id, callback_query.message.message_id,
+                           referral_report_text(rollups, period), referral_report_keyboard(period))
+    except TelegramBadRequest:
+        # The report has not changed since the last refresh
+        pass
 
 
 # Handler for adding a new referral
@@ -68,7 +92,7 @@ async def referrals_add(callback_query: CallbackQuery, bot: Bot, db: MongoDbClie
     keyboard = build_keyboard_referrals(str(new_id))
     # Edit the message to display the new referral's details
     await edit_message(bot, callback_query.from_user.id, callback_query.message.message_id,
-                       f'ID : {info.id}\n\nLink : {info.link}\nClicks : {info.clicks}\n\n', keyboard)
+                       f'ID : {info.id}\n\nLink : {info.link}\nClicks : {referral_clicks_total(info)}\n\n', keyboard)
 
 
 # Handler for removing a referral
@@ -88,7 +112,8 @@ async def remove_sponsor(callback_query: CallbackQuery, bot: Bot, callback_data:
     for referral in referrals_list:
         builder.row(InlineKeyboardButton(text=referral['id'],
                                          callback_data=ReferralSelect(id=referral['id']).pack()))
-    # Add buttons for adding a new referral and going back to the admin panel
+    # Add buttons for the report, adding a new referral and going back to the admin panel
+    builder.row(InlineKeyboardButton(text='📊 Отчет', callback_data=ReferralReport().pack()))
     builder.row(InlineKeyboardButton(text='Добавить', callback_data=AddReferral().pack()))
     builder.row(InlineKeyboardButton(text='Назад', callback_data=AdminRefs().pack()))
     # Edit the message to display the updated list of referrals
@@ -1,4 +1,6 @@
 import os
+
+import aiofiles
 from aiogram import Bot, Router
 from aiogram.types import CallbackQuery, FSInputFile
 from src.callbacks import AdminUpload
@@ -6,23 +8,25 @@ from src.utils.db import MongoDbClient
 
 router = Router()
 
+# How many user ids are written to the file at once
+WRITE_CHUNK = 5000
+
 
 # Admin-panel Stats
 @router.callback_query(AdminUpload.filter())
 async def upload_users(callback_query: CallbackQuery, db: MongoDbClient, bot: Bot):
     await callback_query.answer('Загрузка')  # Send a response to the callback query
 
-    # Fetch users from the database with a limit of 10 billion
-    users = await db.users.find({}, count=10000000000)
-    txt = ''
-
-    # Iterate over each user and append their ID to the text string
-    for user in users:
-        txt += f'{user.id}\n'
-
-    # Write the user IDs to a file named 'users.txt'
-    with open('users.txt', 'w') as f:
-        f.write(txt)
+    # Stream user IDs from the database into 'users.txt' chunk by chunk, so memory stays constant
+    async with aiofiles.open('users.txt', 'w') as f:
+        chunk = []
+        async for user in db.users.iterate({}, batch_size=WRITE_CHUNK, projection={'id': 1, '_id': 0}, raw=True):
+            chunk.append(f'{user["id"]}\n')
+            if len(chunk) >= WRITE_CHUNK:
+                await f.write(''.join(chunk))
+                chunk = []
+        if chunk:
+            await f.write(''.join(chunk))
 
     # Send the 'users.txt' file to the user who initiated the callback query
     await bot.send_document(chat_id=callback_query.from_user.id, document=FSInputFile('users.txt'))
@@ -3,10 +3,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from src.callbacks import Reply, GetLink, SendAgain, Start, ShareLink
+from src.utils.channel_registry import channel_registry
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import SendMessage
-from src.utils.functions.user.functions import check_all_subs, not_subscribe, start_with_referer, start_without_referer, \
-    plus_sub, adv_show
+from src.utils.functions.user.functions import check_subs, missing_channels, not_subscribe, start_with_referer, \
+    start_without_referer, plus_sub, is_subscription_recheck, get_bot_me
+from src.utils.adv_delivery import adv_delivery
 
 router = Router()
 
@@ -18,11 +20,10 @@ async def reply_callback(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
     # Clear any existing FSM state to avoid conflicts
     await state.clear()
     # Check if the user is subscribed to all sponsor channels
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
-    all_subscribed = await check_all_subs(bot, callback_query.from_user.id, channels_list)
-    if all_subscribed:
+    channels_list = await channel_registry.get(db)
+    verdicts = await check_subs(bot, callback_query.from_user.id, channels_list,
+                                fresh=is_subscription_recheck(callback_query))
+    if all(verdicts.values()):
         # If subscribed, increment the subscription count
         await plus_sub(channels_list, db, callback_query.from_user.id)
 
@@ -47,7 +48,7 @@ async def reply_callback(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
         callback = Reply(sender=int(callback_data.sender), action='reply',
                          referer=int(callback_data.referer),
                          reply_message=callback_data.reply_message).pack()
-        await not_subscribe(bot, callback_query.from_user.id, channels_list,
+        await not_subscribe(bot, callback_query.from_user.id, missing_channels(channels_list, verdicts),
                             callback, int(callback_query.message.message_id))
 
 
@@ -55,14 +56,13 @@ async def reply_callback(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
 @router.callback_query(GetLink.filter())
 async def get_link(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient, callback_data: GetLink):
     # Check if the user is subscribed to all sponsor channels
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
-    all_subscribed = await check_all_subs(bot, callback_query.from_user.id, channels_list)
-    if all_subscribed:
+    channels_list = await channel_registry.get(db)
+    verdicts = await check_subs(bot, callback_query.from_user.id, channels_list,
+                                fresh=is_subscription_recheck(callback_query))
+    if all(verdicts.values()):
         # If subscribed, increment the subscription count
         await plus_sub(channels_list, db, callback_query.from_user.id)
-        me = await bot.get_me()
+        me = await get_bot_me(bot)
         await callback_query.answer('My link')
         referer = callback_data.referer
 
@@ -114,9 +114,9 @@ async def get_link(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient, c
     else:
         # If not subscribed, prompt the user to subscribe
         callback = GetLink(referer=int(callback_data.referer), check_my=callback_data.check_my).pack()
-        await not_subscribe(bot, callback_query.from_user.id, channels_list,
+        await not_subscribe(bot, callback_query.from_user.id, missing_channels(channels_list, verdicts),
                             callback, int(callback_query.message.message_id))
-    await adv_show(callback_query.from_user.id, bot, db)
+    adv_delivery.schedule(callback_query.from_user.id, bot, db)
 
 
 # Send one more question FSM start
@@ -126,11 +126,10 @@ async def send_again(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient,
     # Clear any existing FSM state to avoid conflicts
     await state.clear()
     # Check if the user is subscribed to all sponsor channels
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
-    all_subscribed = await check_all_subs(bot, callback_query.from_user.id, channels_list)
-    if all_subscribed:
+    channels_list = await channel_registry.get(db)
+    verdicts = await check_subs(bot, callback_query.from_user.id, channels_list,
+                                fresh=is_subscription_recheck(callback_query))
+    if all(verdicts.values()):
         # If subscribed, increment the subscription count
         await plus_sub(channels_list, db, callback_query.from_user.id)
         reply_target = callback_data.referer
@@ -153,7 +152,7 @@ async def send_again(callback_query: CallbackQuery, bot: Bot, db: MongoDbClient,
     else:
         # If not subscribed, prompt the user to subscribe
         callback = SendAgain(referer=int(callback_data.referer), action='send').pack()
-        await not_subscribe(bot, callback_query.from_user.id, channels_list,
+        await not_subscribe(bot, callback_query.from_user.id, missing_channels(channels_list, verdicts),
                             callback, int(callback_query.message.message_id))
 
 
@@ -169,11 +168,10 @@ async def reply_callback(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
     except:
         pass
     # Check if the user is subscribed to all sponsor channels
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
-    all_subscribed = await check_all_subs(bot, callback_query.from_user.id, channels_list)
-    if all_subscribed:
+    channels_list = await channel_registry.get(db)
+    verdicts = await check_subs(bot, callback_query.from_user.id, channels_list,
+                                fresh=is_subscription_recheck(callback_query))
+    if all(verdicts.values()):
         # If subscribed, increment the subscription count
         await plus_sub(channels_list, db, callback_query.from_user.id)
         if callback_data.message.startswith('/start ') and len(callback_data.message.split('/start ')[1]) > 0:
@@ -185,16 +183,16 @@ async def reply_callback(callback_query: CallbackQuery, bot: Bot, db: MongoDbCli
     else:
         # If not subscribed, prompt the user to subscribe
         callback = Start(message=callback_data.message).pack()
-        await not_subscribe(bot, callback_query.from_user.id, channels_list,
+        await not_subscribe(bot, callback_query.from_user.id, missing_channels(channels_list, verdicts),
                             callback, int(callback_query.message.message_id))
-    await adv_show(callback_query.from_user.id, bot, db)
+    adv_delivery.schedule(callback_query.from_user.id, bot, db)
 
 
 # Share link callback
 @router.callback_query(ShareLink.filter())
 async def share_link_callback(callback_query: CallbackQuery, bot: Bot, callback_data: ShareLink):
     # Получаем информацию о боте
-    me = await bot.get_me()
+    me = await get_bot_me(bot)
     # Формируем персональную ссылку
     personal_link = f"https://t.me/{me.username}?start={callback_data.user_id}"
     
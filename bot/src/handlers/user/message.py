@@ -4,10 +4,14 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
+from src.models.user import User
 from src.utils.db import MongoDbClient
 from src.utils.fsm_state import SendMessage
-from src.utils.functions.user.functions import (send_message_with_referer, adv_show, show_advert, handle_start,
-                                                handle_subscription_check, get_referral_id_from_env, track_referral_usage)
+from src.utils.functions.user.functions import (send_message_with_referer, show_advert, handle_start,
+                                                handle_subscription_check, track_referral_usage,
+                                                track_link_message)
+from src.utils.referral_routing import referral_router
+from src.utils.adv_delivery import adv_delivery
 from src.utils.text import hello_referer
 
 router = Router()
@@ -15,60 +19,55 @@ router = Router()
 
 # Handle the /start command
 @router.message(Command('start'))
-async def start(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext):
+async def start(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext, user: User):
     # Split the message text by spaces
     split_message = message.text.split(' ')
-    # Find the user in the database
-    user = await db.users.find_one({'id': message.from_user.id})
+    # The user document is loaded (or created) by UserMiddleware
     
-    # Проверяем, есть ли реф ID в переменной окружения
-    env_referral_ids = get_referral_id_from_env()
+    # Таблица реф ID (загружается один раз и обновляется без перезапуска)
+    routes = referral_router.routes
     
-    # Проверяем, есть ли реф ID в переменной окружения и пришел ли пользователь по реф ссылке
-    if env_referral_ids and len(split_message) > 1:
-        user_id_from_link = split_message[1]
-        # Проверяем, совпадает ли ID из ссылки с одним из реф ID
-        for env_referral_id in env_referral_ids:
-            if str(message.from_user.id) != str(env_referral_id) and user_id_from_link == str(env_referral_id):
-                # Если пользователь пришел по реф ссылке из переменной окружения
-                # Отслеживаем использование реф ссылки из переменной окружения
-                user_info = {
-                    'id': message.from_user.id,
-                    'username': message.from_user.username,
-                    'first_name': message.from_user.first_name,
-                    'last_name': message.from_user.last_name
-                }
-                await track_referral_usage(int(env_referral_id), user_info)
-                # Отправляем специальное сообщение пользователю, который пришел по реф ссылке
-                await message.answer(hello_referer, parse_mode='html')
-                # Устанавливаем состояние для отправки сообщения
-                await state.set_state(SendMessage.send_message)
-                await state.update_data(referer=env_referral_id, action='send')
-                return  # Прерываем выполнение, чтобы не отправлять второе сообщение
+    # Проверяем, пришел ли пользователь по одной из реф ссылок
+    if routes and len(split_message) > 1:
+        referral_id = routes.match_link(split_message[1])
+        if referral_id is not None and referral_id != message.from_user.id:
+            # Если пользователь пришел по реф ссылке из таблицы, отслеживаем ее использование
+            user_info = {
+                'id': message.from_user.id,
+                'username': message.from_user.username,
+                'first_name': message.from_user.first_name,
+                'last_name': message.from_user.last_name
+            }
+            track_referral_usage(referral_id, user_info, is_click=True)
+            # Отправляем специальное сообщение пользователю, который пришел по реф ссылке
+            await message.answer(hello_referer, parse_mode='html')
+            # Устанавливаем состояние для отправки сообщения
+            await state.set_state(SendMessage.send_message)
+            await state.update_data(referer=referral_id, action='send')
+            return  # Прерываем выполнение, чтобы не отправлять второе сообщение
     
-    # Если пользователь уже был в боте, но пришел не по реф ссылке из переменной окружения,
-    # но переменная окружения установлена, то также отслеживаем его активность
-    if not user.first_start and env_referral_ids and str(message.from_user.id) not in [str(ref_id) for ref_id in env_referral_ids]:
-        # Отслеживаем использование реф ссылки из переменной окружения
+    # Если пользователь уже был в боте, но пришел не по реф ссылке из таблицы,
+    # но реф ID заданы, то также отслеживаем его активность
+    if not user.first_start and routes and message.from_user.id not in routes:
+        # Отслеживаем использование реф ссылок из таблицы
         user_info = {
             'id': message.from_user.id,
             'username': message.from_user.username,
             'first_name': message.from_user.first_name,
             'last_name': message.from_user.last_name
         }
-        for env_referral_id in env_referral_ids:
-            await track_referral_usage(int(env_referral_id), user_info)
+        for referral_id in routes:
+            track_referral_usage(referral_id, user_info)
     
     if user.first_start:
-        # If this is the user's first start, update the database
-        await db.users.update_one({'id': message.from_user.id}, {'first_start': False})
+        # If this is the user's first start (UserMiddleware has already cleared the flag in the database)
         # handle_start will send its own welcome message, so we don't need to send it here
         await handle_start(message, bot, db, state, split_message)
     else:
         await handle_subscription_check(bot, message, db, state, split_message)
-        # Show advertisement only for returning users
+        # Show advertisement only for returning users (in the background)
         await show_advert(message.from_user.id)
-        await adv_show(message.from_user.id, bot, db)
+        adv_delivery.schedule(message.from_user.id, bot, db)
 
 
 # Handle admin command specifically to avoid processing it as a message to referer
@@ -85,7 +84,7 @@ async def admin_command(message: Message, bot: Bot, db: MongoDbClient, state: FS
 
 # Handle sending and replying to messages
 @router.message(SendMessage.send_message)
-async def send_message(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext):
+async def send_message(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext, user: User):
     # Get the FSM context data
     data = await state.get_data()
     if data.get('referer'):
@@ -98,15 +97,15 @@ async def send_message(message: Message, bot: Bot, db: MongoDbClient, state: FSM
         # If there is no referer, send an error message
         await message.answer("❗️ <b>Не удалось отправить сообщение.</b>\n\n"
                              "ℹ️ <i>Отсутствует получатель. Попробуйте начать сначала.</i>")
-    # Show advertisement
-    await show_advert(message.from_user.id)
-    await adv_show(message.from_user.id, bot, db)
     # Clear the FSM state
     await state.clear()
+    # Show advertisement in the background, the user already has the confirmation
+    await show_advert(message.from_user.id)
+    adv_delivery.schedule(message.from_user.id, bot, db)
     
-    # Проверяем, есть ли реф ID в переменной окружения
-    env_referral_ids = get_referral_id_from_env()
-    if env_referral_ids and str(message.from_user.id) not in [str(ref_id) for ref_id in env_referral_ids]:
+    # Проверяем, заданы ли реф ID (таблица в памяти, проверка за O(1))
+    routes = referral_router.routes
+    if routes and message.from_user.id not in routes:
         # Отслеживаем каждое сообщение пользователя, если он пришел по реф ссылке
         user_info = {
             'id': message.from_user.id,
@@ -115,8 +114,10 @@ async def send_message(message: Message, bot: Bot, db: MongoDbClient, state: FSM
             'last_name': message.from_user.last_name
         }
         message_content = message.text or message.caption or None
-        for env_referral_id in env_referral_ids:
-            await track_referral_usage(int(env_referral_id), user_info, message_content)
+        for referral_id in routes:
+            track_referral_usage(referral_id, user_info, message_content, is_message=True)
+    # Сообщение также засчитывается реф ссылке, по которой пользователь пришел
+    track_link_message(user)
 
 
 # Handle all other commands when not in FSM state - ensure they are properly handled
@@ -135,7 +136,7 @@ async def handle_commands(message: Message, bot: Bot, db: MongoDbClient, state:
 
 # Handle all other messages when not in FSM state - provide helpful response
 @router.message()
-async def handle_other_messages(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext):
+async def handle_other_messages(message: Message, bot: Bot, db: MongoDbClient, state: FSMContext, user: User):
     # Check if user is in FSM state
     current_state = await state.get_state()
     if current_state == SendMessage.send_message:
@@ -143,9 +144,9 @@ async def handle_other_messages(message: Message, bot: Bot, db: MongoDbClient, s
         # This is a fallback to ensure messages are processed correctly
         await message.answer("💬 <b>Введите ваше сообщение для отправки.</b>\n\n"
                              "❌ <i>Для отмены операции используйте /start</i>")
-    # Проверяем, есть ли реф ID в переменной окружения
-    env_referral_ids = get_referral_id_from_env()
-    if env_referral_ids and str(message.from_user.id) not in [str(ref_id) for ref_id in env_referral_ids]:
+    # Проверяем, заданы ли реф ID (таблица в памяти, проверка за O(1))
+    routes = referral_router.routes
+    if routes and message.from_user.id not in routes:
         # Отслеживаем каждое сообщение пользователя, если он пришел по реф ссылке
         user_info = {
             'id': message.from_user.id,
@@ -154,5 +155,7 @@ async def handle_other_messages(message: Message, bot: Bot, db: MongoDbClient, s
             'last_name': message.from_user.last_name
         }
         message_content = message.text or message.caption or None
-        for env_referral_id in env_referral_ids:
-            await track_referral_usage(int(env_referral_id), user_info, message_content)
+        for referral_id in routes:
+            track_referral_usage(referral_id, user_info, message_content, is_message=True)
+    # Сообщение также засчитывается реф ссылке, по которой пользователь пришел
+    track_link_message(user)
@@ -6,8 +6,11 @@ from typing import Dict
 
 from aiogram import BaseMiddleware
 from aiogram.types import Update, Message
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from src.models.user import User
+from src.utils.write_behind import user_updates
 
 
 class UserMiddleware(BaseMiddleware):
@@ -15,6 +18,60 @@ class UserMiddleware(BaseMiddleware):
     def __init__(self) -> None:
         pass
 
+    @staticmethod
+    def refer_id(text: str):
+        """ID пригласившего из параметра deep link /start rl<id>, иначе None"""
+        parts = text.split(maxsplit=1) if text and text.startswith('/start') else []
+        payload = parts[1].strip() if len(parts) > 1 else ''
+        if payload.startswith('rl') and payload[2:].isdigit():
+            return int(payload[2:])
+        return None
+
+    @staticmethod
+    async def register(users, event: Message) -> User:
+        """
+        Регистрирует пользователя и снимает флаг first_start одним атомарным upsert.
+        Возвращаемая модель содержит first_start до обновления, чтобы /start понял, что это первый запуск
+        """
+        is_start = bool(event.text) and event.text.startswith('/start')
+
+        new_user = event.from_user.model_dump()
+        new_user['created_at'] = int(time.time())
+        new_user['updated_at'] = int(time.time())
+        refer_id = UserMiddleware.refer_id(event.text)
+        if refer_id is not None:
+            new_user['refer_id'] = refer_id
+
+        # В базу пишется полный документ с умолчаниями модели, как и раньше при insert_one
+        new_user = User(**new_user).model_dump()
+        update = {'$setOnInsert': new_user}
+        if is_start:
+            new_user.pop('first_start')
+            update['$set'] = {'first_start': False}
+
+        # Кэши сбрасываем сами и только если документ действительно изменился (см. ниже)
+        try:
+            before = await users.find_one_and_update({'id': event.from_user.id}, update, upsert=True,
+                                                     return_document=ReturnDocument.BEFORE, raw=True,
+                                                     invalidate=False)
+        except DuplicateKeyError:
+            # Параллельный upsert уже вставил документ - повторный запрос его просто обновит
+            before = await users.find_one_and_update({'id': event.from_user.id}, update, upsert=True,
+                                                     return_document=ReturnDocument.BEFORE, raw=True,
+                                                     invalidate=False)
+
+        # Документ до обновления (None - пользователь только что создан) и после него
+        first_start = True if before is None else before.get('first_start', True)
+        after = {**(before or new_user), **update.get('$set', {})}
+        after.pop('_id', None)
+        user = User(**after)
+        if users.cache is not None:
+            users.cache[user.id] = user
+        if before is not None and is_start and first_start:
+            # Флаг first_start снят у существующего документа - остальные процессы перечитают его
+            users.publish_invalidation([user.id], local=False)
+        return user.model_copy(update={'first_start': first_start})
+
     async def __call__(
             self,
             handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
@@ -24,32 +81,29 @@ class UserMiddleware(BaseMiddleware):
         if not hasattr(event, 'from_user'):
             return
 
-        user = await data['db'].users.find_one(f={'id': event.from_user.id})
+        users = data['db'].users
 
         if isinstance(event, Message):
+            # Пользователь обычно берется из in-process кэша без запроса к базе
+            user = users.cache.get(event.from_user.id) if users.cache is not None else None
+            is_start = bool(event.text) and event.text.startswith('/start')
 
-            if user is None:
-                if hasattr(event, 'text'):
-
-                    new_user = event.from_user.model_dump()
-                    new_user['created_at'] = int(time.time())
-                    new_user['updated_at'] = int(time.time())
-
-                    try:
-                        if 'rl' in event.text:
-                            new_user['refer_id'] = int(event.text.replace('rl', ''))
-                    except:  # noqa
-                        ...
+            if user is None and not is_start:
+                # Вернувшийся пользователь не в кэше: обычное чтение (оно же заполнит кэш), а не upsert
+                user = await users.find_one({'id': event.from_user.id})
+            if user is None or (is_start and user.first_start):
+                # Новый пользователь или первый /start: один upsert вместо find_one + insert_one + update_one
+                user = await self.register(users, event)
 
-                    user = User(**new_user)
-                    await data['db'].users.insert_one(user.model_dump())
+            if user.blocked_at is not None:
+                user_updates.set(event.from_user.id, {'blocked_at': None})
 
-            else:
-                if user.blocked_at is not None:
-                    await data['db'].users.update_one({'chat_id': event.from_user.id}, {'blocked_at': None})
+        else:
+            user = await users.find_one(f={'id': event.from_user.id})
 
-        if user.updated_at < time.time() - 300:
-            await data['db'].users.update_one({'chat_id': event.from_user.id}, event.from_user.model_dump())
+        # Профиль обновляется через буфер отложенной записи, а не отдельным запросом
+        if user is not None and user.updated_at < time.time() - 300:
+            user_updates.set(event.from_user.id, {**event.from_user.model_dump(), 'updated_at': int(time.time())})
 
         data['user'] = user
         return await handler(event, data)
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class AdvStats(BaseModel):
+    """
+    Показы рекламного поста за день (day = 'YYYY-MM-DD') или за все время (day = 'total')
+    """
+    adv_id: int
+    day: str
+    impressions: int = 0
@@ -0,0 +1,10 @@
+from pydantic import BaseModel
+
+
+class ChannelMember(BaseModel):
+    """
+    Пользователь, засчитанный подписчиком спонсорского канала
+    """
+    channel_id: int
+    user_id: int
+    joined_at: int = 0  # Когда пользователь был засчитан впервые
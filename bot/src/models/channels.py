@@ -8,5 +8,4 @@ class Channels(BaseModel):
     url: str
     name: str
     subs: Union[int, None] = 0
-    subscribed_users: Union[list, None] = []
 
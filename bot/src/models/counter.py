@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+
+
+class Counter(BaseModel):
+    """
+    Атомарная последовательность (например, для новых adv_id)
+    """
+    id: str
+    value: int = 0
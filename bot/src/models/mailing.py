@@ -0,0 +1,23 @@
+from typing import Union
+
+from pydantic import BaseModel
+
+
+class MailingJob(BaseModel):
+    """
+    Задание рассылки с сохраненным прогрессом
+    """
+    id: str
+    admin_id: int  # Кто запустил рассылку
+    message_id: int  # Сообщение, которое копируется пользователям
+    progress_message_id: Union[int, None] = None  # Сообщение с прогрессом у админа
+    status: str = 'running'  # running / finished / failed
+    owner: Union[str, None] = None  # Процесс, который ведет рассылку
+    lease_until: int = 0  # До какого времени задание занято владельцем
+    last_user_id: Union[int, None] = None  # Чекпоинт курсора по users.id
+    total: int = 0
+    success: int = 0
+    failed: int = 0
+    created_at: int = 0
+    updated_at: int = 0
+    finished_at: Union[int, None] = None
@@ -0,0 +1,16 @@
+from typing import Union
+from pydantic import BaseModel
+
+
+class ReferralAttribution(BaseModel):
+    """
+    Привязка пользователя к реф ссылке: один документ на пару (referrer_id, user_id)
+    """
+    referrer_id: int  # ID пользователя, чья реф ссылка была использована
+    user_id: int  # ID пользователя, который перешел по ссылке
+    user_username: Union[str, None] = None  # Username пользователя (последний известный)
+    user_first_name: Union[str, None] = None  # Имя пользователя
+    user_last_name: Union[str, None] = None  # Фамилия пользователя
+    first_seen: int = 0  # Первое событие по ссылке
+    last_seen: int = 0  # Последнее событие по ссылке
+    messages: int = 0  # Сколько сообщений пользователь отправил
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class ReferralRollup(BaseModel):
+    """
+    Счетчики реф ссылки (kind = 'link') или реферера (kind = 'referrer') за час или за день.
+    bucket - 'YYYY-MM-DDTHH' для почасовых и 'YYYY-MM-DD' для дневных
+    """
+    kind: str
+    ref: str
+    bucket: str
+    clicks: int = 0
+    uniques: int = 0  # Уникальные пользователи за bucket
+    messages: int = 0
+
+
+class ReferralRollupUser(BaseModel):
+    """
+    Отметка, что пользователь уже посчитан в uniques за bucket (удаляется по TTL после expires_at)
+    """
+    granularity: str  # hour / day
+    kind: str
+    ref: str
+    bucket: str
+    user_id: int
+    expires_at: datetime
@@ -0,0 +1,11 @@
+from pydantic import BaseModel, ConfigDict
+
+
+class Settings(BaseModel):
+    """
+    Документ настроек бота, меняемых без перезапуска (например, id = 'referral_routing')
+    """
+    model_config = ConfigDict(extra='allow')
+
+    id: str
+    updated_at: int = 0
@@ -10,6 +10,7 @@ class User(BaseModel):
     first_start: Union[bool, None] = True
     first_name: str
     adv_id: Union[int, None] = 1
+    ref_link: Union[str, None] = None  # Реф ссылка (referrals.id), по которой пользователь пришел впервые
     last_name: Union[str, None] = None
     username: Union[str, None] = None
     language_code: Union[str, None] = None
@@ -0,0 +1,136 @@
+import bisect
+import logging
+import os
+
+from pymongo import ReturnDocument
+
+from src.utils.redis_cache import redis_cache
+from src.utils.snapshot import Snapshot
+from src.utils.write_behind import user_updates
+
+log = logging.getLogger('adverts')
+
+# Сколько живет указатель ротации пользователя в Redis без показов (в секундах)
+ADV_POINTER_TTL = int(os.getenv("ADV_POINTER_TTL", 30 * 24 * 3600))
+
+
+class AdvIndex:
+    """
+    Неизменяемый снимок рекламных постов, упорядоченный по adv_id.
+    Поиск текущего/следующего/предыдущего поста - бинарный поиск по массиву id
+    """
+    def __init__(self, posts: list):
+        posts = sorted(posts, key=lambda post: post.adv_id)
+        self.ids = [post.adv_id for post in posts]
+        self.posts = posts
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, adv_id: int):
+        index = bisect.bisect_left(self.ids, adv_id)
+        if index < len(self.ids) and self.ids[index] == adv_id:
+            return self.posts[index]
+        return None
+
+    def first(self):
+        return self.posts[0] if self.posts else None
+
+    def last(self):
+        return self.posts[-1] if self.posts else None
+
+    def next(self, adv_id: int):
+        """Пост со следующим по порядку adv_id или None"""
+        index = bisect.bisect_right(self.ids, adv_id)
+        return self.posts[index] if index < len(self.posts) else None
+
+    def prev(self, adv_id: int):
+        """Пост с предыдущим по порядку adv_id или None"""
+        index = bisect.bisect_left(self.ids, adv_id)
+        return self.posts[index - 1] if index > 0 else None
+
+    def position(self, adv_id: int) -> int:
+        """Позиция поста adv_id, а если его удалили - следующего за ним (по кругу)"""
+        index = bisect.bisect_left(self.ids, adv_id)
+        return index if index < len(self.ids) else 0
+
+    def at(self, position: int):
+        """Пост по позиции, взятой по модулю числа постов"""
+        return self.posts[position % len(self.posts)] if self.posts else None
+
+    def at_or_after(self, adv_id: int):
+        """Пост adv_id, а если его удалили - следующий за ним (по кругу)"""
+        return self.at(self.position(adv_id)) if self.posts else None
+
+
+class AdvCatalog(Snapshot):
+    """
+    Рекламные посты в памяти процесса.
+    Загружаются из базы один раз и перечитываются после любых изменений коллекции adv
+    (в этом или другом процессе - через шину инвалидации)
+    """
+    def __init__(self):
+        super().__init__('adv')
+
+    async def _load(self, db) -> AdvIndex:
+        return AdvIndex([post async for post in db.adv.iterate({'adv_id': {'$ne': None}})])
+
+
+adv_catalog = AdvCatalog()
+
+
+def _pointer_key(user_id: int) -> str:
+    return f"adv_ptr:{user_id}"
+
+
+async def next_user_adv(db, user_id: int):
+    """
+    Следующий рекламный пост для пользователя.
+    Указатель ротации - счетчик в Redis: INCR выдает номер показа, пост - (номер - 1) по модулю
+    числа постов. В users.adv_id пишется только снимок (следующий пост) через буфер отложенной записи,
+    по нему счетчик восстанавливается, если ключа в Redis нет
+    """
+    adv_index = await adv_catalog.get(db)
+    if not len(adv_index):
+        return None
+    key = _pointer_key(user_id)
+    try:
+        pipe = redis_cache.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, ADV_POINTER_TTL)
+        counter, _ = await pipe.execute()
+        if counter == 1:
+            # Новый указатель - продолжаем с позиции из снимка в базе
+            user = await db.users.find_one({'id': int(user_id)})
+            seed = adv_index.position(int(user.adv_id or 1)) if user else 0
+            if seed:
+                counter = await redis_cache.client.incrby(key, seed)
+        position = counter - 1
+    except Exception as e:
+        # Без Redis ротация идет по снимку из базы
+        log.debug(f'Adv pointer for {user_id} is not available: {e}')
+        user = await db.users.find_one({'id': int(user_id)})
+        if not user:
+            return None
+        position = adv_index.position(int(user.adv_id or 1))
+    adv_query = adv_index.at(position)
+    user_updates.set(int(user_id), {'adv_id': int(adv_index.at(position + 1).adv_id)})
+    return adv_query
+
+
+async def next_sequence(db, name: str, floor: int = 0) -> int:
+    """
+    Следующее значение атомарной последовательности name из коллекции counters.
+    floor - нижняя граница (например, максимальный существующий id), чтобы не выдать уже занятый
+    """
+    if floor:
+        await db.counters.find_one_and_update({'id': name}, {'$max': {'value': floor}}, upsert=True, raw=True)
+    counter = await db.counters.find_one_and_update({'id': name}, {'$inc': {'value': 1}}, upsert=True,
+                                                    return_document=ReturnDocument.AFTER, raw=True)
+    return int(counter['value'])
+
+
+async def next_adv_id(db) -> int:
+    """Новый adv_id; последовательность не выдает один id двум параллельным добавлениям"""
+    last = (await adv_catalog.get(db)).last()
+    return await next_sequence(db, 'adv_id', floor=last.adv_id if last else 0)
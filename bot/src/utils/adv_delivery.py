@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+
+from src.utils.functions.user.functions import adv_show
+
+log = logging.getLogger('adverts')
+
+# Сколько показов может ждать в очереди; лишние отбрасываются
+ADV_QUEUE_SIZE = int(os.getenv("ADV_QUEUE_SIZE", 1000))
+# Количество фоновых отправителей рекламы
+ADV_WORKERS = int(os.getenv("ADV_WORKERS", 4))
+
+
+class AdvDelivery:
+    """
+    Фоновая доставка рекламы: обработчики только ставят показ в ограниченную очередь
+    и не ждут ни выбора поста, ни отправки. При переполнении показ отбрасывается
+    """
+    def __init__(self, maxsize: int = ADV_QUEUE_SIZE, workers: int = ADV_WORKERS):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = workers
+        # Пользователи, для которых показ уже стоит в очереди
+        self.queued = set()
+        self.dropped = 0
+        self.tasks = []
+
+    def schedule(self, user_id: int, bot, db) -> bool:
+        """Поставить показ в очередь; False, если он отброшен"""
+        if user_id in self.queued:
+            return False
+        try:
+            self.queue.put_nowait((user_id, bot, db))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                log.warning(f'Adv queue is full, {self.dropped} impressions dropped so far')
+            return False
+        self.queued.add(user_id)
+        return True
+
+    async def _worker(self):
+        while True:
+            user_id, bot, db = await self.queue.get()
+            self.queued.discard(user_id)
+            try:
+                await adv_show(user_id, bot, db)
+            except Exception as e:
+                # Ошибка показа рекламы не должна влиять на пользователя
+                log.warning(f'Failed to show adv to {user_id}: {e}')
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 5):
+        """Дать очереди доработать timeout секунд и остановить отправителей (при остановке бота)"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f'Adv queue closed with {self.queue.qsize()} impressions left')
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+
+# Очередь показов рекламы
+adv_delivery = AdvDelivery()
@@ -0,0 +1,315 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from cachetools import TTLCache
+
+from src.callbacks import AdminPanel
+from src.models.mailing import MailingJob
+
+log = logging.getLogger('broadcast')
+
+# Глобальный лимит Telegram ~30 сообщений в секунду на бота
+GLOBAL_RATE = float(os.getenv("MAILING_RATE", 30))
+# Лимит на один чат ~1 сообщение в секунду
+PER_CHAT_RATE = 1.0
+# Количество одновременных отправителей
+WORKERS = int(os.getenv("MAILING_WORKERS", 25))
+# Размер пачки пользователей, читаемой из базы за раз
+BATCH_SIZE = 500
+# Как часто обновлять сообщение с прогрессом (в секундах)
+PROGRESS_INTERVAL = 10
+# Сколько раз повторять отправку после RetryAfter
+MAX_RETRIES = 3
+# Сколько секунд задание остается за процессом без продления аренды;
+# после этого его может забрать и продолжить другой процесс
+LEASE_TTL = int(os.getenv("MAILING_LEASE_TTL", 60))
+# Владелец заданий, запущенных этим процессом
+PROCESS_ID = uuid.uuid4().hex
+
+# Держим ссылки на фоновые задачи, чтобы их не собрал GC
+_running_tasks = set()
+# Рассылки, которые сейчас идут в этом процессе, по id задания
+active_broadcasts = {}
+
+
+class LeaseLost(Exception):
+    """Аренду задания рассылки перехватил другой процесс"""
+
+
+class TokenBucket:
+    """
+    Token bucket: не больше rate токенов в секунду, с запасом capacity
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться и забрать один токен"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Заблокировать бакет на seconds секунд (ответ RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RateLimiter:
+    """
+    Общий лимит на бота плюс отдельный бакет на каждый чат
+    """
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE):
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets = TTLCache(maxsize=100_000, ttl=60)
+
+    async def acquire(self, chat_id: int):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        await bucket.acquire()
+        await self.global_bucket.acquire()
+
+
+class Broadcast:
+    """
+    Рассылка сообщения всем пользователям в фоне с ограничением скорости.
+    Прогресс сохраняется в коллекцию mailings после каждой пачки
+    """
+    def __init__(self, bot, db, job: MailingJob, limiter: RateLimiter = None):
+        self.bot = bot
+        self.db = db
+        self.job = job
+        self.limiter = limiter or RateLimiter()
+        self.started_at = None
+        self.processed_at_start = 0
+        self.finished = False
+
+    @property
+    def processed(self) -> int:
+        return self.job.success + self.job.failed
+
+    def rate(self) -> float:
+        """Текущая скорость отправки, сообщений в секунду"""
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return (self.processed - self.processed_at_start) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> float:
+        """Оценка оставшегося времени в секундах"""
+        rate = self.rate()
+        return max(self.job.total - self.processed, 0) / rate if rate > 0 else 0.0
+
+    def progress_text(self) -> str:
+        return (f'Рассылка идёт...\n'
+                f'Отправлено: {self.processed} из {self.job.total}\n'
+                f'Успешно: {self.job.success}\nНеудачно: {self.job.failed}\n'
+                f'Скорость: {self.rate():.1f} сообщ./с\n'
+                f'Осталось: ~{int(self.eta() // 60)} мин {int(self.eta() % 60)} с')
+
+    async def _send(self, chat_id: int):
+        for _ in range(MAX_RETRIES + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.copy_message(chat_id=chat_id, from_chat_id=self.job.admin_id,
+                                            message_id=self.job.message_id, parse_mode='html')
+                self.job.success += 1
+                return
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать - останавливаем всех отправителей
+                log.warning(f'Flood control, sleeping {e.retry_after}s')
+                self.limiter.global_bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                break
+            except Exception as e:
+                log.error(f'Failed to send mailing to {chat_id}: {e}')
+                break
+        self.job.failed += 1
+
+    async def _send_batch(self, chat_ids: list):
+        semaphore = asyncio.Semaphore(WORKERS)
+
+        async def send(chat_id):
+            async with semaphore:
+                await self._send(chat_id)
+
+        await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+        # Все пользователи пачки обработаны - сохраняем чекпоинт
+        await self._save({'last_user_id': chat_ids[-1]})
+
+    async def _save(self, fields: dict):
+        """Сохранить прогресс и продлить аренду; LeaseLost, если задание уже ведет другой процесс"""
+        self.job.updated_at = int(time.time())
+        fields = {'lease_until': self.job.updated_at + LEASE_TTL, **fields}
+        res = await self.db.mailings.update_one({'id': self.job.id, 'owner': PROCESS_ID}, {
+            'success': self.job.success, 'failed': self.job.failed, 'total': self.job.total,
+            'updated_at': self.job.updated_at, **fields})
+        if not res.matched_count:
+            raise LeaseLost(self.job.id)
+        for key, value in fields.items():
+            setattr(self.job, key, value)
+
+    async def _report_progress(self):
+        while not self.finished:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if self.finished:
+                return
+            log.info(f'Mailing {self.job.id} progress: {self.processed}/{self.job.total}, '
+                     f'{self.rate():.1f} msg/s, eta {self.eta():.0f}s')
+            try:
+                # Продлеваем аренду и между пачками, если пачка отправляется дольше LEASE_TTL
+                await self._save({})
+            except LeaseLost:
+                return
+            except Exception as e:
+                log.warning(f'Failed to renew mailing {self.job.id} lease: {e}')
+            if self.job.progress_message_id:
+                try:
+                    await self.bot.edit_message_text(chat_id=self.job.admin_id,
+                                                     message_id=self.job.progress_message_id,
+                                                     text=self.progress_text())
+                except Exception:
+                    pass
+
+    async def run(self):
+        self.started_at = time.monotonic()
+        self.processed_at_start = self.processed
+        # При возобновлении считаем всех: уже обработанные плюс оставшиеся после чекпоинта
+        f = {'id': {'$gt': self.job.last_user_id}} if self.job.last_user_id is not None else {}
+        self.job.total = self.processed + await self.db.users.count(f)
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            batch = []
+            async for user in self.db.users.iterate(f, batch_size=BATCH_SIZE, projection={'id': 1, '_id': 0},
+                                                    raw=True, sort=[('id', 1)]):
+                batch.append(int(user['id']))
+                if len(batch) >= BATCH_SIZE:
+                    await self._send_batch(batch)
+                    batch = []
+            if batch:
+                await self._send_batch(batch)
+            await self._save({'status': 'finished', 'finished_at': int(time.time())})
+        finally:
+            self.finished = True
+            reporter.cancel()
+        log.info(f'Mailing {self.job.id} finished: {self.job.success} ok, {self.job.failed} failed in '
+                 f'{time.monotonic() - self.started_at:.0f}s')
+
+
+# Notify the admin of the mailing results
+async def report_results(broadcast: Broadcast):
+    keyboard = InlineKeyboardBuilder()
+    keyboard.row(InlineKeyboardButton(text='Назад', callback_data=AdminPanel().pack()))
+    job = broadcast.job
+    if job.progress_message_id:
+        try:
+            await broadcast.bot.delete_message(chat_id=job.admin_id, message_id=job.progress_message_id)
+        except Exception:
+            pass
+    await broadcast.bot.send_message(chat_id=job.admin_id,
+                                     text=f'Рассылка отправлена!\nВсего пользователей: {job.total}\n'
+                                          f'Успешно: {job.success}\nНеудачно: {job.failed}',
+                                     reply_markup=keyboard.as_markup())
+
+
+async def create_mailing(db, admin_id: int, message_id: int, progress_message_id: int = None) -> MailingJob:
+    """
+    Создает новое задание рассылки в коллекции mailings
+    """
+    now = int(time.time())
+    job = MailingJob(id=str(uuid.uuid4()), admin_id=admin_id, message_id=message_id,
+                     progress_message_id=progress_message_id, owner=PROCESS_ID, lease_until=now + LEASE_TTL,
+                     created_at=now, updated_at=now)
+    await db.mailings.insert_one(job.model_dump())
+    return job
+
+
+def start_broadcast(broadcast: Broadcast, on_done=report_results) -> asyncio.Task:
+    """
+    Запускает рассылку фоновой задачей, on_done вызывается по завершении
+    """
+    async def runner():
+        active_broadcasts[broadcast.job.id] = broadcast
+        try:
+            await broadcast.run()
+        except LeaseLost:
+            log.warning(f'Mailing {broadcast.job.id} was taken over by another process')
+            return
+        except Exception as e:
+            log.error(f'Mailing {broadcast.job.id} crashed: {e}', exc_info=True)
+            await mark_failed(broadcast)
+            return
+        finally:
+            active_broadcasts.pop(broadcast.job.id, None)
+        if on_done is not None:
+            await on_done(broadcast)
+
+    task = asyncio.create_task(runner())
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return task
+
+
+async def mark_failed(broadcast: Broadcast):
+    """Сохранить статус failed упавшей рассылки, чтобы она не числилась идущей"""
+    job = broadcast.job
+    try:
+        await broadcast.db.mailings.update_one({'id': job.id, 'owner': PROCESS_ID}, {
+            'status': 'failed', 'success': job.success, 'failed': job.failed, 'total': job.total,
+            'updated_at': int(time.time()), 'finished_at': int(time.time())})
+        job.status = 'failed'
+    except Exception as e:
+        log.error(f'Failed to mark mailing {job.id} as failed: {e}')
+
+
+async def claim_mailing(db):
+    """
+    Атомарно забирает одно идущее задание, аренда которого истекла (владелец остановился или упал)
+    """
+    now = int(time.time())
+    return await db.mailings.find_one_and_update(
+        {'status': 'running', '$or': [{'lease_until': {'$lt': now}}, {'lease_until': {'$exists': False}}]},
+        {'$set': {'owner': PROCESS_ID, 'lease_until': now + LEASE_TTL}})
+
+
+async def resume_mailings(bot, db):
+    """
+    Возобновляет рассылки, прерванные остановкой своего или другого процесса, с последнего чекпоинта.
+    Каждое задание забирается атомарно, поэтому одну рассылку продолжает только один процесс
+    """
+    resumed = 0
+    while (job := await claim_mailing(db)) is not None:
+        log.info(f'Resuming mailing {job.id} after user {job.last_user_id}')
+        start_broadcast(Broadcast(bot, db, job))
+        resumed += 1
+    return resumed
+
+
+async def watch_mailings(bot, db):
+    """Периодически забирает задания с истекшей арендой (запускается фоновой задачей)"""
+    while True:
+        try:
+            await resume_mailings(bot, db)
+        except Exception as e:
+            log.error(f'Failed to resume mailings: {e}')
+        await asyncio.sleep(LEASE_TTL)
@@ -0,0 +1,156 @@
+import asyncio
+import functools
+import logging
+
+from cachetools import TTLCache
+
+from src.utils.invalidation import invalidation_bus
+from src.utils.redis_cache import redis_cache
+
+log = logging.getLogger('cache')
+
+# Все двухуровневые кэши процесса по namespace
+caches = {}
+
+
+class TwoTierCache:
+    """
+    Двухуровневый кэш результатов корутин:
+    L1 - ограниченный LRU/TTL кэш в памяти процесса, L2 - Redis, общий для всех процессов.
+    Одновременные промахи по одному ключу выполняют загрузку один раз (single-flight).
+    Каждый ключ имеет версию в Redis: invalidate увеличивает ее, и записи старых версий
+    (в том числе сохраненные загрузками, начатыми до инвалидации) больше не читаются
+    """
+    def __init__(self, namespace: str, ttl: int = 300, l1_ttl: int = None, maxsize: int = 1024, model=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.l1 = TTLCache(maxsize=maxsize, ttl=l1_ttl or ttl)
+        self.model = model
+        self.inflight = {}
+        self.versions = {}
+        caches[namespace] = self
+        invalidation_bus.subscribe(f'cache:{namespace}', self._on_invalidation)
+
+    def _keys(self, key):
+        return f"cache:{self.namespace}:{key}", f"cache_ver:{self.namespace}:{key}"
+
+    def _encode(self, value):
+        if self.model is None:
+            return value
+        if isinstance(value, list):
+            return [item.model_dump(mode='json') for item in value]
+        return value.model_dump(mode='json')
+
+    def _decode(self, value):
+        if self.model is None:
+            return value
+        if isinstance(value, list):
+            return [self.model.model_validate(item) for item in value]
+        return self.model.model_validate(value)
+
+    async def get_or_load(self, key, loader):
+        """Значение из L1, иначе из L2, иначе результат loader() с записью в оба уровня"""
+        while True:
+            if key in self.l1:
+                return self.l1[key]
+            future = self.inflight.get(key)
+            if future is None:
+                break
+            # Такой же промах уже загружается - ждем его результат
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Отменили сам вызов - пробрасываем; отменили загрузку - пробуем заново
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        local_version = self.versions.get(key, 0)
+        try:
+            value = await self._load(key, loader)
+            # Если ключ инвалидировали во время загрузки, значение уже устарело
+            if self.versions.get(key, 0) == local_version:
+                self.l1[key] = value
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Ошибку получает вызывающий, ожидающих может не быть
+            raise
+        finally:
+            # Загрузку отменили (CancelledError) - отпускаем ожидающих, иначе они зависнут
+            if not future.done():
+                future.cancel()
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    async def _load(self, key, loader):
+        data_key, version_key = self._keys(key)
+        version, entry = await redis_cache.get_many([version_key, data_key])
+        version = version or 0
+        if entry is not None and entry.get('v') == version:
+            return self._decode(entry['d'])
+        value = await loader()
+        if value is not None:
+            await redis_cache.set(data_key, {'v': version, 'd': self._encode(value)}, self.ttl)
+        return value
+
+    def drop_local(self, key=None):
+        """Сбросить L1 (один ключ или весь) без обращения к Redis"""
+        if key is None:
+            self.l1.clear()
+            self.inflight.clear()
+            for cached_key in list(self.versions):
+                self.versions[cached_key] += 1
+            return
+        self.versions[key] = self.versions.get(key, 0) + 1
+        self.l1.pop(key, None)
+        self.inflight.pop(key, None)
+
+    def _on_invalidation(self, keys):
+        if keys is None:
+            self.drop_local()
+            return
+        for key in keys:
+            self.drop_local(key)
+
+    async def invalidate(self, key):
+        """Инвалидировать ключ во всех процессах: новая версия в Redis и сброс L1"""
+        self.drop_local(key)
+        invalidation_bus.publish(f'cache:{self.namespace}', [key], local=False)
+        data_key, version_key = self._keys(key)
+        try:
+            pipe = redis_cache.pipeline()
+            pipe.incr(version_key)
+            # Версия живет дольше данных, чтобы старые записи не стали снова актуальными
+            pipe.expire(version_key, self.ttl * 2)
+            pipe.delete(data_key)
+            await pipe.execute()
+        except Exception as e:
+            log.warning(f'Failed to invalidate {data_key}: {e}')
+
+
+def _make_key(args, kwargs):
+    return ':'.join([str(arg) for arg in args] + [f'{name}={value}' for name, value in sorted(kwargs.items())])
+
+
+def cached(namespace: str, ttl: int = 300, l1_ttl: int = None, maxsize: int = 1024, model=None, key=None):
+    """
+    Декоратор для корутин: результат кэшируется в L1 и L2 по ключу из аргументов
+    (или по key(*args, **kwargs)). model - pydantic модель для хранения результата в Redis.
+    Инвалидация: await func.invalidate(key)
+    """
+    def decorator(func):
+        cache = TwoTierCache(namespace, ttl=ttl, l1_ttl=l1_ttl, maxsize=maxsize, model=model)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key else _make_key(args, kwargs)
+            return await cache.get_or_load(cache_key, lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.invalidate = cache.invalidate
+        return wrapper
+
+    return decorator
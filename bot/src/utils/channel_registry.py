@@ -0,0 +1,103 @@
+import logging
+import re
+import time
+
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.utils.snapshot import Snapshot
+
+log = logging.getLogger('channels')
+
+BOT_LINK_PATTERN = re.compile(r'\?start=')
+SUB_CHECK_BUTTON_TEXT = '✅ Проверить подписку'
+
+
+class ChannelRegistry(Snapshot):
+    """
+    Список спонсорских каналов в памяти процесса.
+    Загружается из базы один раз и сбрасывается при изменениях из админки
+    (в этом или другом процессе - через шину инвалидации)
+    """
+    def __init__(self):
+        super().__init__('channels')
+
+    async def _load(self, db) -> list:
+        channels = await db.channels.find({})
+        return [
+            {
+                'channel_id': channel.channel_id,
+                'url': channel.url,
+                'name': channel.name,
+                'is_bot_link': bool(BOT_LINK_PATTERN.search(channel.url)),
+                # Готовая кнопка для клавиатуры "подпишитесь на спонсоров"
+                'button': InlineKeyboardButton(text=channel.name, url=channel.url.replace(';', ':')),
+            }
+            for channel in channels
+        ]
+
+    @staticmethod
+    def subscribe_markup(channels_list, callback):
+        """Клавиатура со ссылками на каналы и кнопкой проверки подписки"""
+        markup = InlineKeyboardBuilder()
+        for channel in channels_list:
+            markup.row(channel['button'])
+        markup.row(InlineKeyboardButton(text=SUB_CHECK_BUTTON_TEXT, callback_data=callback))
+        return markup
+
+
+channel_registry = ChannelRegistry()
+
+
+async def migrate_channel_members(db, chunk: int = 5000):
+    """
+    Переносит старые массивы subscribed_users из документов каналов в коллекцию channel_members
+    и выставляет subs по числу уникальных пользователей
+    """
+    async for channel in db.channels.iterate({'subscribed_users': {'$exists': True}},
+                                             projection={'channel_id': 1, 'subscribed_users': 1}, raw=True):
+        users = list(dict.fromkeys(channel.get('subscribed_users') or []))
+        now = int(time.time())
+        for i in range(0, len(users), chunk):
+            members = [{'channel_id': channel['channel_id'], 'user_id': user_id, 'joined_at': now}
+                       for user_id in users[i:i + chunk]]
+            try:
+                await db.channel_members.insert_many(members)
+            except BulkWriteError:
+                # Часть пользователей уже перенесена
+                pass
+        subs = await db.channel_members.count({'channel_id': channel['channel_id']})
+        await db.channels.update_many({'channel_id': channel['channel_id']},
+                                      {'$set': {'subs': subs}, '$unset': {'subscribed_users': ''}})
+        log.info(f'Moved {len(users)} subscribers of channel {channel["channel_id"]} to channel_members')
+
+
+async def move_channel_members(db, old_channel_id: int, new_channel_id: int, chunk: int = 5000):
+    """
+    Переносит участников канала на новый channel_id (после смены ID спонсора).
+    Пары, которые уже есть у нового ID, не дублируются: участники копируются upsert'ами, затем старые удаляются
+    """
+    if old_channel_id == new_channel_id:
+        return
+    members = []
+    async for member in db.channel_members.iterate({'channel_id': old_channel_id},
+                                                   projection={'user_id': 1, 'joined_at': 1, '_id': 0}, raw=True):
+        members.append(UpdateOne({'channel_id': new_channel_id, 'user_id': member['user_id']},
+                                 {'$setOnInsert': {'joined_at': member.get('joined_at', int(time.time()))}},
+                                 upsert=True))
+        if len(members) >= chunk:
+            await _upsert_members(db, members)
+            members = []
+    if members:
+        await _upsert_members(db, members)
+    await db.channel_members.delete_many({'channel_id': old_channel_id})
+
+
+async def _upsert_members(db, requests: list):
+    try:
+        await db.channel_members.bulk_write(requests)
+    except BulkWriteError:
+        # Параллельный upsert уже вставил часть пар
+        pass
@@ -0,0 +1,105 @@
+import logging
+import os
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.utils.db import db
+from src.utils.flusher import PeriodicFlusher
+
+log = logging.getLogger('counters')
+
+# Бакет с итогом за все время рядом с дневными
+TOTAL_BUCKET = 'total'
+
+
+class CounterBuffer(PeriodicFlusher):
+    """
+    Буфер счетчиков: приращения копятся в памяти по ключу документа
+    и сбрасываются в базу одним bulk_write с $inc по таймеру
+    или при достижении max_pending ключей.
+    upsert=False - приращения для несуществующих (например, удаленных) документов отбрасываются
+    """
+    def __init__(self, collection, flush_interval: float = 10, max_pending: int = 1000, upsert: bool = True):
+        super().__init__(flush_interval, max_pending)
+        self.collection = collection
+        self.upsert = upsert
+        # Приращения записываемой сейчас порции: учитываются в pending_value, пока запись не подтверждена
+        self.inflight = {}
+
+    def incr(self, key: dict, field: str, amount: int = 1):
+        """Запланировать $inc поля field на amount для документа с ключом key"""
+        fields = self.pending.setdefault(tuple(sorted(key.items())), {})
+        fields[field] = fields.get(field, 0) + amount
+        if len(self.pending) >= self.max_pending:
+            self.flush_soon()
+
+    def pending_value(self, key: dict, field: str) -> int:
+        """Еще не записанное в базу приращение поля field документа key (включая записываемое сейчас)"""
+        key = tuple(sorted(key.items()))
+        return self.pending.get(key, {}).get(field, 0) + self.inflight.get(key, {}).get(field, 0)
+
+    def _take(self) -> dict:
+        self.inflight = super()._take()
+        return self.inflight
+
+    def _merge(self, key, fields: dict):
+        # Складываем с приращениями, накопленными за время записи
+        current = self.pending.setdefault(key, {})
+        for field, amount in fields.items():
+            current[field] = current.get(field, 0) + amount
+
+    async def _write(self, pending: dict):
+        keys = list(pending)
+        requests = [UpdateOne(dict(key), {'$inc': pending[key]}, upsert=self.upsert) for key in keys]
+        try:
+            # Счетчики нигде не кэшируются, поэтому кэши не сбрасываем
+            await self.collection.bulk_write(requests, invalidate=False)
+        except BulkWriteError as e:
+            # Остальные приращения уже применены; повторяем только упавшие, иначе они задвоятся
+            self._requeue(pending, [keys[error['index']] for error in e.details.get('writeErrors', [])])
+        except Exception as e:
+            log.error(f'Failed to flush {len(requests)} counters: {e}')
+            self._requeue(pending)
+        finally:
+            # Записанное уже в базе, незаписанное вернулось в pending
+            self.inflight = {}
+
+
+def today() -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+# Показы рекламных постов по дням
+adv_counters = CounterBuffer(db.adv_stats, flush_interval=float(os.getenv("ADV_STATS_FLUSH_INTERVAL", 10)))
+
+
+# Клики по реф ссылкам (поле clicks документов referrals)
+referral_clicks = CounterBuffer(db.referrals, flush_interval=float(os.getenv("REFERRAL_CLICKS_FLUSH_INTERVAL", 5)),
+                                upsert=False)
+
+
+def count_adv_impression(adv_id: int):
+    """Засчитать показ поста: в дневной бакет и в итог за все время"""
+    for day in (today(), TOTAL_BUCKET):
+        adv_counters.incr({'adv_id': int(adv_id), 'day': day}, 'impressions')
+
+
+async def get_adv_impressions(db, adv_id: int) -> tuple:
+    """Показы поста (всего, сегодня): два документа по уникальному индексу плюс еще не записанное"""
+    days = {TOTAL_BUCKET: 0, today(): 0}
+    for stats in await db.adv_stats.find({'adv_id': int(adv_id), 'day': {'$in': list(days)}}):
+        days[stats.day] = stats.impressions
+    return tuple(days[day] + adv_counters.pending_value({'adv_id': int(adv_id), 'day': day}, 'impressions')
+                 for day in (TOTAL_BUCKET, today()))
+
+
+def count_referral_click(ref: str):
+    """Засчитать клик по реф ссылке ref (запишется одним $inc за интервал)"""
+    referral_clicks.incr({'id': ref}, 'clicks')
+
+
+def referral_clicks_total(referral) -> int:
+    """Клики ссылки: сохраненное в базе значение плюс еще не записанные"""
+    return int(referral.clicks or 0) + referral_clicks.pending_value({'id': referral.id}, 'clicks')
@@ -2,13 +2,23 @@ import os
 from typing import List, Any
 
 import motor.motor_asyncio
+from cachetools import TTLCache
 from pydantic import BaseModel
+from pymongo import ReturnDocument, WriteConcern
 
 from src.models.adv import Adv
 from src.models.channels import Channels
 from src.models.referrals import Referrals
 from src.models.user import User
 from src.models.referral_tracking import ReferralTracking
+from src.models.mailing import MailingJob
+from src.models.channel_members import ChannelMember
+from src.models.counter import Counter
+from src.models.adv_stats import AdvStats
+from src.models.referral_attribution import ReferralAttribution
+from src.models.settings import Settings
+from src.models.referral_rollup import ReferralRollup, ReferralRollupUser
+from src.utils.invalidation import invalidation_bus
 
 # В первую очередь используем MONGO_URI, которую Railway предоставляет автоматически при подключении базы данных
 MONGO_URI = os.getenv("MONGO_URI")
@@ -56,41 +66,129 @@ external_db = external_client[os.getenv("MONGO_DB_NAME", "default_db")]
 
 class Collection:
 
-    def __init__(self, model, collection_name: str):
+    def __init__(self, model, collection_name: str, cache: TTLCache = None, cache_key: str = 'id',
+                 entity: str = None):
         db_name = os.getenv("MONGO_DB_NAME", "default_db")
         self.collection = client[db_name][collection_name]
         self.model = model
+        # Необязательный in-process кэш моделей по полю cache_key (например, users по Telegram id)
+        self.cache = cache
+        self.cache_key = cache_key
+        # Увеличивается при каждом сбросе кэша: чтение, начатое до сброса, не кладет результат в кэш
+        self.generation = 0
+        # Имя сущности на шине инвалидации: записи в коллекцию сбрасывают кэши во всех процессах
+        self.entity = entity
+        if entity:
+            invalidation_bus.subscribe(entity, self._drop)
 
-    async def find_one(self, f: dict):
-        data = await self.collection.find_one(f)
+    def _cached_key(self, f: dict):
+        # Ключ кэша, если фильтр вида {cache_key: значение}, иначе None
+        if self.cache is None or len(f) != 1 or self.cache_key not in f:
+            return None
+        key = f[self.cache_key]
+        return key if isinstance(key, (int, str)) else None
+
+    def _drop(self, keys: list = None):
+        # Обработчик шины: сбросить документы keys из кэша (None - весь кэш)
+        if self.cache is None:
+            return
+        self.generation += 1
+        if keys is None:
+            self.cache.clear()
+            return
+        for key in keys:
+            self.cache.pop(key, None)
+
+    def _filter_keys(self, filters: list):
+        # Ключи cache_key из фильтров; None, если хотя бы один фильтр их не определяет
+        keys = []
+        for f in filters:
+            key = f.get(self.cache_key) if f else None
+            if not isinstance(key, (int, str)):
+                return None
+            keys.append(key)
+        return keys
+
+    def _invalidate(self, *filters: dict):
+        # Сбрасываем закэшированные документы; если по фильтру их не определить - весь кэш
+        keys = self._filter_keys(filters)
+        if self.entity:
+            # Локальный кэш сбрасывает свой же обработчик шины
+            self.publish_invalidation(keys)
+        else:
+            self._drop(keys)
+
+    def publish_invalidation(self, keys: list = None, local: bool = True):
+        """
+        Сообщить об изменении документов keys (None - любых) всем процессам.
+        local=False - только другим процессам, если кэш этого уже актуален
+        """
+        if self.entity and keys != []:
+            invalidation_bus.publish(self.entity, keys, local=local)
+
+    def _build(self, data: dict, raw: bool = False):
+        # Приводим документ к модели коллекции (или отдаем как есть при raw=True)
+        if raw:
+            return data
+        if '_id' in data:
+            data['_id'] = str(data['_id'])
+        return self.model(**data)
+
+    async def find_one(self, f: dict, projection: dict = None, raw: bool = False):
+        key = self._cached_key(f) if projection is None and not raw else None
+        if key is not None and key in self.cache:
+            return self.cache[key]
+        generation = self.generation
+        data = await self.collection.find_one(f, projection)
         if not data:
             return None
-        data['_id'] = str(data['_id'])
-        model = self.model(**data)
+        model = self._build(data, raw)
+        if key is not None and self.generation == generation:
+            self.cache[key] = model
         return model
 
-    async def find(self, f: dict, count: int = 100) -> List:
-        data = self.collection.find(f).to_list(length=count)
+    async def find(self, f: dict, count: int = 100, sort: list = None, projection: dict = None,
+                   raw: bool = False) -> List:
+        cursor = self.collection.find(f, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        data = cursor.to_list(length=count)
         list_models = []
         for item in await data:
-            item['_id'] = str(item['_id'])
-            list_models.append(self.model(**item))
+            list_models.append(self._build(item, raw))
         return list_models
 
+    async def iterate(self, f: dict, batch_size: int = 500, projection: dict = None, raw: bool = False,
+                      sort: list = None):
+        """
+        Асинхронный итератор по документам: читает курсор пачками по batch_size,
+        поэтому в памяти никогда не держится вся коллекция.
+        raw=True отдает словари без построения модели (нужно при projection без обязательных полей)
+        """
+        cursor = self.collection.find(f, projection).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for item in cursor:
+            yield self._build(item, raw)
+
     async def update_one(self, f: dict, s: dict, upsert: bool = False):
         res = await self.collection.update_one(f, {'$set': s}, upsert=upsert)
+        self._invalidate(f)
         return res
 
     async def delete_one(self, f: dict, ):
         res = await self.collection.delete_one(f)
+        self._invalidate(f)
         return res
 
     async def delete_many(self, f: dict, ):
         res = await self.collection.delete_many(f)
+        self._invalidate(f)
         return res
 
     async def update_many(self, f: dict, s: dict):
         res = await self.collection.update_many(f, s)
+        self._invalidate(f)
         return res
 
     async def count(self, f: dict):
@@ -99,38 +197,50 @@ class Collection:
 
     async def insert_one(self, i: dict):
         res = await self.collection.insert_one(i)
+        self.publish_invalidation(self._filter_keys([i]))
         return res
 
-    async def find_one_with_min_adv_id(self):
-        data = await self.collection.find().sort('adv_id', 1).limit(1).to_list(length=1)
-        if not data:
-            return None
-        data[0]['_id'] = str(data[0]['_id'])
-        model = self.model(**data[0])
-        return model
-
-    async def find_one_with_next_adv_id(self, current_adv_id: int):
-        data = await self.collection.find({'adv_id': {'$gt': current_adv_id}}).sort('adv_id', 1).limit(1).to_list(length=1)
-        if not data:
-            return None
-        data[0]['_id'] = str(data[0]['_id'])
-        model = self.model(**data[0])
-        return model
+    async def insert_many(self, i: List[dict], ordered: bool = False, write_concern: WriteConcern = None):
+        # write_concern позволяет ослабить подтверждение записи для некритичных данных (например, событий)
+        collection = self.collection.with_options(write_concern=write_concern) if write_concern else self.collection
+        res = await collection.insert_many(i, ordered=ordered)
+        self.publish_invalidation(self._filter_keys(i))
+        return res
 
-    async def find_one_with_prev_adv_id(self, current_adv_id: int):
-        data = await self.collection.find({'adv_id': {'$lt': current_adv_id}}).sort('adv_id', -1).limit(1).to_list(length=1)
-        if not data:
+    async def bulk_write(self, requests: list, ordered: bool = False, invalidate: bool = True, keys: list = None):
+        """
+        Выполняет пачку операций (UpdateOne, InsertOne, ...) за один запрос к базе.
+        keys - значения cache_key затронутых документов; без них сбрасываются все закэшированные документы.
+        invalidate=False оставляет кэш как есть (если вызывающий уже обновил его сам)
+        """
+        if not requests:
             return None
-        data[0]['_id'] = str(data[0]['_id'])
-        model = self.model(**data[0])
-        return model
+        try:
+            return await self.collection.bulk_write(requests, ordered=ordered)
+        finally:
+            # И при BulkWriteError: часть операций уже применена
+            if invalidate:
+                self._invalidate(*([{self.cache_key: key} for key in keys] if keys is not None else [{}]))
 
-    async def find_one_with_max_adv_id(self):
-        data = await self.collection.find().sort('adv_id', -1).limit(1).to_list(length=1)
+    async def find_one_and_update(self, f: dict, u: dict, upsert: bool = False, projection: dict = None,
+                                  return_document: bool = ReturnDocument.AFTER, raw: bool = False,
+                                  invalidate: bool = True):
+        """
+        Атомарно обновляет документ и возвращает его.
+        В отличие от update_one, u передается целиком с операторами ($set, $inc, $setOnInsert, ...).
+        invalidate=False не сбрасывает кэши (для счетчиков, которые нигде не кэшируются)
+        """
+        data = await self.collection.find_one_and_update(f, u, projection=projection, upsert=upsert,
+                                                         return_document=return_document)
+        if invalidate:
+            self._invalidate(f)
         if not data:
             return None
-        data[0]['_id'] = str(data[0]['_id'])
-        model = self.model(**data[0])
+        model = self._build(data, raw)
+        # Свежий документ сразу кладем в кэш вместо следующего чтения из базы
+        key = self._cached_key(f)
+        if key is not None and not raw and projection is None and return_document == ReturnDocument.AFTER:
+            self.cache[key] = model
         return model
 
 
@@ -140,14 +250,35 @@ class MongoDbClient(BaseModel):
     referrals: Any
     adv: Any
     referral_tracking: Any
+    mailings: Any
+    channel_members: Any
+    counters: Any
+    adv_stats: Any
+    referral_attribution: Any
+    settings: Any
+    referral_rollup_hourly: Any
+    referral_rollup_daily: Any
+    referral_rollup_users: Any
+
 
+# Кэш пользователей по Telegram id: ограничен по размеру (LRU) и по времени жизни
+users_cache = TTLCache(maxsize=int(os.getenv("USER_CACHE_SIZE", 50_000)), ttl=int(os.getenv("USER_CACHE_TTL", 600)))
 
 db = MongoDbClient(
-    users=Collection(collection_name='users', model=User),
-    channels=Collection(collection_name='channels', model=Channels),
-    referrals = Collection(collection_name='referrals', model=Referrals),
-    adv=Collection(collection_name='adv', model=Adv),
-    referral_tracking=Collection(collection_name='referral_tracking', model=ReferralTracking)  # Новая коллекция
+    users=Collection(collection_name='users', model=User, cache=users_cache, entity='users'),
+    channels=Collection(collection_name='channels', model=Channels, cache_key='channel_id', entity='channels'),
+    referrals = Collection(collection_name='referrals', model=Referrals, entity='referrals'),
+    adv=Collection(collection_name='adv', model=Adv, cache_key='adv_id', entity='adv'),
+    referral_tracking=Collection(collection_name='referral_tracking', model=ReferralTracking),  # Новая коллекция
+    mailings=Collection(collection_name='mailings', model=MailingJob),
+    channel_members=Collection(collection_name='channel_members', model=ChannelMember),
+    counters=Collection(collection_name='counters', model=Counter),
+    adv_stats=Collection(collection_name='adv_stats', model=AdvStats),
+    referral_attribution=Collection(collection_name='referral_attribution', model=ReferralAttribution),
+    settings=Collection(collection_name='settings', model=Settings, entity='settings'),
+    referral_rollup_hourly=Collection(collection_name='referral_rollup_hourly', model=ReferralRollup),
+    referral_rollup_daily=Collection(collection_name='referral_rollup_daily', model=ReferralRollup),
+    referral_rollup_users=Collection(collection_name='referral_rollup_users', model=ReferralRollupUser)
 )
 
 
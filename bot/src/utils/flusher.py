@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+log = logging.getLogger('flusher')
+
+
+class PeriodicFlusher:
+    """
+    Основа буферов фоновой записи: накопленное в self.pending записывается по таймеру
+    раз в flush_interval секунд, при переполнении (flush_soon) и при остановке бота (close).
+    Подкласс реализует _write(pending) - запись забранной порции - и _merge(key, value),
+    которым _requeue возвращает незаписанное в буфер, объединяя с пришедшим за время записи
+    """
+    def __init__(self, flush_interval: float, max_pending: int = None):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = self._empty()
+        self.lock = asyncio.Lock()
+        self.task = None
+        # Держим ссылки на внеочередные записи, чтобы их не собрал GC посреди записи
+        self._flushing = set()
+
+    def _empty(self):
+        return {}
+
+    def _has_pending(self) -> bool:
+        return bool(self.pending)
+
+    def _take(self):
+        # Забрать накопленное; новые события копятся в свежем буфере во время записи
+        pending, self.pending = self.pending, self._empty()
+        return pending
+
+    async def _write(self, pending):
+        raise NotImplementedError
+
+    def _merge(self, key, value):
+        raise NotImplementedError
+
+    def _requeue(self, pending: dict, keys=None):
+        """Вернуть в буфер незаписанные ключи keys (None - все) порции pending"""
+        for key in pending if keys is None else keys:
+            self._merge(key, pending[key])
+
+    def flush_soon(self):
+        """Запустить внеочередную запись, если запись сейчас не идет"""
+        if self.lock.locked() or self._flushing:
+            return
+        task = asyncio.create_task(self.flush())
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self):
+        """Записать все накопленное"""
+        async with self.lock:
+            if not self._has_pending():
+                return
+            await self._write(self._take())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f'{type(self).__name__} flush failed: {e}')
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        """Остановить таймер и записать остаток (вызывается при остановке бота)"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+        await self.flush()
@@ -0,0 +1,49 @@
+import os
+import time
+
+from cachetools import TTLCache
+
+# Не больше ADV_MAX_IMPRESSIONS показов рекламы пользователю за ADV_WINDOW секунд
+ADV_MAX_IMPRESSIONS = int(os.getenv("ADV_MAX_IMPRESSIONS", 6))
+ADV_WINDOW = int(os.getenv("ADV_WINDOW", 3600))
+# Минимальный интервал между показами одному пользователю (в секундах)
+ADV_MIN_GAP = int(os.getenv("ADV_MIN_GAP", 60))
+
+
+class FrequencyCap:
+    """
+    Ограничение частоты показов: не больше max_impressions за скользящее окно window
+    и не чаще одного раза в min_gap секунд. 0 отключает соответствующее ограничение.
+    На пользователя хранится кортеж времен последних показов (не длиннее max_impressions)
+    """
+    def __init__(self, max_impressions: int = ADV_MAX_IMPRESSIONS, window: int = ADV_WINDOW,
+                 min_gap: int = ADV_MIN_GAP, maxsize: int = 200_000):
+        self.max_impressions = max_impressions
+        self.window = window
+        self.min_gap = min_gap
+        # Записи живут не дольше окна: после него старые показы все равно не учитываются
+        self.impressions = TTLCache(maxsize=maxsize, ttl=max(window, min_gap, 1))
+
+    def _recent(self, user_id: int, now: float) -> tuple:
+        # Времена показов, еще попадающих в окно
+        shown = self.impressions.get(user_id, ())
+        return tuple(t for t in shown if now - t < self.window)
+
+    def allow(self, user_id: int) -> bool:
+        """Можно ли показать рекламу сейчас (показ не засчитывается - для этого record)"""
+        now = time.monotonic()
+        shown = self.impressions.get(user_id, ())
+        if shown and self.min_gap and now - shown[-1] < self.min_gap:
+            return False
+        return not self.max_impressions or len(self._recent(user_id, now)) < self.max_impressions
+
+    def record(self, user_id: int):
+        """Засчитать показ (вызывается после успешной отправки)"""
+        now = time.monotonic()
+        # Хранится не больше max_impressions времен: старшие для лимита уже не нужны
+        shown = self._recent(user_id, now)[-(self.max_impressions - 1):] if self.max_impressions > 1 else ()
+        self.impressions[user_id] = shown + (now,)
+
+
+# Ограничение показов рекламы в adv_show
+adv_cap = FrequencyCap()
@@ -7,21 +7,29 @@ from aiogram.types import InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from src.callbacks import AddSponsor, SponsorList, RemoveSponsor, ReferralList, RemoveReferral, AdminRefs, AdvEdit, \
-    AdminPanel, AdvNav, AddAdv, AdvRemove
+    AdminPanel, AdvNav, AddAdv, AdvRemove, AdvStatsView, ReferralReport
+from src.utils.channel_registry import channel_registry
 from src.utils.photo import no_photo
 
+# How many links and referrers the referral report lists
+REPORT_TOP = 20
 
-# Function to update channel data in the database
-async def update_channel_data(db, filter, update):
+
+# Function to update channel data in the database, returns True if the channel document was found and updated
+async def update_channel_data(db, filter, update) -> bool:
     try:
         # Attempt to update the channel data
         result = await db.channels.update_one(filter, update)
-        if result.modified_count > 0:
+        # Sponsor list in memory must be reloaded after the change
+        channel_registry.invalidate()
+        if result.matched_count > 0:
             logging.info('Document successfully updated.')
-        else:
-            logging.info('Document for update not found.')
+            return True
+        logging.info('Document for update not found.')
     except Exception as e:
+        # For example, the new channel_id is already taken by another sponsor (unique index)
         logging.error(f'Error updating document: {e}')
+    return False
 
 
 # Function to build a keyboard for channel management
@@ -60,13 +68,59 @@ def build_keyboard_referrals(ref_id):
     return keyboard
 
 
+# Function to build the impressions button of an advertisement post
+def adv_stats_button(adv_id, impressions):
+    total, today = impressions
+    return InlineKeyboardButton(text=f'👁 Показы: {total} (сегодня: {today})',
+                                callback_data=AdvStatsView(adv_id=int(adv_id)).pack())
+
+
+# Function to build the referral report text from rollup documents
+def referral_report_text(rollups, period):
+    title = 'за 24 часа (по часам, UTC)' if period == 'hour' else 'за 7 дней (по дням, UTC)'
+    by_bucket, by_ref = {}, {}
+    for rollup in rollups:
+        for totals in (by_bucket.setdefault(rollup.bucket, {'clicks': 0, 'uniques': 0, 'messages': 0}),
+                       by_ref.setdefault((rollup.kind, rollup.ref), {'clicks': 0, 'uniques': 0, 'messages': 0})):
+            totals['clicks'] += rollup.clicks
+            totals['uniques'] += rollup.uniques
+            totals['messages'] += rollup.messages
+    if not rollups:
+        return f'📊 Рефералы {title}\n\nДанных пока нет.'
+
+    def line(totals):
+        return f"клики: {totals['clicks']}, уник.: {totals['uniques']}, сообщ.: {totals['messages']}"
+
+    lines = [f'📊 Рефералы {title}', '', 'По периодам:']
+    lines += [f'{bucket.replace("T", " ")}{":00" if period == "hour" else ""} — {line(totals)}'
+              for bucket, totals in sorted(by_bucket.items())]
+    lines += ['', 'По ссылкам и реферерам:']
+    top = sorted(by_ref.items(), key=lambda item: -(item[1]['clicks'] + item[1]['messages']))[:REPORT_TOP]
+    lines += [f'{"🔗" if kind == "link" else "👤"} {ref} — {line(totals)}' for (kind, ref), totals in top]
+    lines += ['', '<i>уник. - сумма уникальных пользователей по периодам</i>']
+    return '\n'.join(lines)
+
+
+# Function to build the keyboard of the referral report
+def referral_report_keyboard(period):
+    keyboard = InlineKeyboardBuilder()
+    other = 'hour' if period == 'day' else 'day'
+    keyboard.row(InlineKeyboardButton(text='По часам' if other == 'hour' else 'По дням',
+                                      callback_data=ReferralReport(period=other).pack()))
+    keyboard.add(InlineKeyboardButton(text='🔄 Обновить', callback_data=ReferralReport(period=period).pack()))
+    keyboard.row(InlineKeyboardButton(text='Назад', callback_data=AdminRefs().pack()))
+    return keyboard
+
+
 # Function to create a keyboard for advertisement management
-def create_keyboard(adv_query, next_adv_query, adv_quantity):
+def create_keyboard(adv_query, next_adv_query, adv_quantity, impressions=None):
     builder = InlineKeyboardBuilder()
+    if impressions is not None:
+        builder.row(adv_stats_button(adv_query.adv_id, impressions))
     builder.row(InlineKeyboardButton(text='Редактировать пост', callback_data=AdvEdit(adv_id=int(adv_query.adv_id)).pack()))
     if int(adv_quantity) >= 2:
         builder.row(InlineKeyboardButton(text='Назад', callback_data=AdminPanel().pack()))
-    if int(adv_quantity) > 1:
+    if int(adv_quantity) > 1 and next_adv_query:
         builder.add(InlineKeyboardButton(text='Следующий', callback_data=AdvNav(index=next_adv_query.adv_id).pack()))
     builder.row(InlineKeyboardButton(text='Добавить пост', callback_data=AddAdv().pack()))
     builder.add(InlineKeyboardButton(text='Удалить пост', callback_data=AdvRemove(adv_id=int(adv_query.adv_id)).pack()))
@@ -1,17 +1,31 @@
+import asyncio
 import os
-import re
+import random
 import traceback
 import uuid
-from datetime import datetime
 import time
 
 import aiohttp
 import logging
-from aiogram.types import InlineKeyboardButton, Message
+from aiogram.types import InlineKeyboardButton, Message, User
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from cachetools import TTLCache
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from src.callbacks import Reply, SendAgain, GetLink, Start
+from src.utils.adv_catalog import next_user_adv
+from src.utils.frequency_cap import adv_cap
+from src.utils.counters import count_adv_impression, count_referral_click
+from src.utils.referral_routing import referral_links
+from src.utils.tracking import referral_attribution, referral_events, REFERRAL_LOG_SAMPLE_RATE
+from src.utils.rollups import referral_rollups
+from src.utils.write_behind import user_updates
+from src.utils.channel_registry import channel_registry, SUB_CHECK_BUTTON_TEXT
 from src.utils.fsm_state import SendMessage
+from src.utils.cache import cached
+from src.utils.invalidation import invalidation_bus
+from src.utils.redis_cache import redis_cache
 from src.utils.photo import send_message_photo, new_message, answer_sended, welcome
 from src.utils.text import hello_referer
 from src.models.referral_tracking import ReferralTracking
@@ -19,6 +33,30 @@ from src.utils.logger import perf_logger
 
 log = logging.getLogger('adverts')
 
+# Timeout for a single get_chat_member call, seconds
+SUB_CHECK_TIMEOUT = float(os.getenv("SUB_CHECK_TIMEOUT", 3))
+MEMBER_STATUSES = ('administrator', 'owner', 'member', 'creator')
+# How long subscription verdicts are cached in Redis, seconds
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", 600))
+SUB_CACHE_NEGATIVE_TTL = int(os.getenv("SUB_CACHE_NEGATIVE_TTL", 30))
+# (channel_id, user_id) pairs already stored in channel_members by this process
+known_members = TTLCache(maxsize=200_000, ttl=3600)
+
+
+# Function to forget stored memberships of changed or removed sponsor channels (None - all channels),
+# so a re-added channel id counts its users into subs again
+def forget_channel_members(channel_ids: list = None):
+    if channel_ids is None:
+        known_members.clear()
+        return
+    channel_ids = set(channel_ids)
+    for key in [key for key in list(known_members) if key[0] in channel_ids]:
+        known_members.pop(key, None)
+
+
+# Any write to db.channels (add, edit, id change, removal) in any process publishes the channel ids
+invalidation_bus.subscribe('channels', forget_channel_members)
+
 
 # Function to sort actions and send messages with referer
 async def send_message_with_referer(message, bot, state, data: dict, referer: int, sender: int):
@@ -40,11 +78,16 @@ async def send_message_with_referer(message, bot, state, data: dict, referer: in
 async def handle_start(message, bot, db, state, split_message):
     # Get the referral link if it exists
     ref = split_message[1] if len(split_message) > 1 else None
-    # Find the referral link in the database
-    ref_link = await db.referrals.find_one({'id': ref}) if ref else None
-    if ref_link:
-        # Update the number of clicks on the referral link
-        await db.referrals.update_one({'id': ref}, {'clicks': int(ref_link.clicks) + 1})
+    # Check the referral link against the link ids kept in memory
+    if ref and ref in await referral_links.get(db):
+        # The click is counted in memory and written with one $inc per flush interval,
+        # and it also goes to the hourly and daily referral rollups
+        count_referral_click(ref)
+        referral_rollups.record('link', ref, message.from_user.id, clicks=1)
+        # Remember the first-touch link so the user's later messages are attributed to it
+        user = await db.users.find_one({'id': message.from_user.id})
+        if user is not None and user.ref_link is None:
+            user_updates.set(message.from_user.id, {'ref_link': ref})
         # Start without referral link
         await start_without_referer(message, bot, state)
     else:
@@ -55,13 +98,11 @@ async def handle_start(message, bot, db, state, split_message):
 
 # Function to check subscription to all sponsor channels
 async def handle_subscription_check(bot, message, db, state, split_message):
-    # Get the list of channels from the database
-    channels = await db.channels.find({})
-    channels_list = [{'channel_id': channel.channel_id, 'url': channel.url, 'name': channel.name} for channel in
-                     channels]
+    # Get the list of channels (kept in memory by the channel registry)
+    channels_list = await channel_registry.get(db)
     # Check subscription to all channels
-    all_subscribed = await check_all_subs(bot, message.from_user.id, channels_list)
-    if all_subscribed:
+    verdicts = await check_subs(bot, message.from_user.id, channels_list)
+    if all(verdicts.values()):
         # Increment the subscription count
         await plus_sub(channels_list, db, message.from_user.id)
         # Handle start with or without a referral link
@@ -69,7 +110,7 @@ async def handle_subscription_check(bot, message, db, state, split_message):
     else:
         # Send a message prompting the user to subscribe
         callback = Start(message=message.text).pack()
-        await not_subscribe(bot, message.from_user.id, channels_list, callback,
+        await not_subscribe(bot, message.from_user.id, missing_channels(channels_list, verdicts), callback,
                             int(message.message_id) if message.message_id else None)
 
 
@@ -284,11 +325,17 @@ async def send_action(message, bot, state, data: dict, referer: int):
                                parse_mode='html', reply_markup=keyboard_sender.as_markup())
 
 
+# Function to get the bot profile, it does not change while the bot is running
+@cached('bot_me', ttl=3600, model=User, key=lambda bot: bot.id)
+async def get_bot_me(bot):
+    return await bot.get_me()
+
+
 # Function to start with referral link
 async def start_with_referer(message, bot, state, text):
     if message.from_user.id != int(text.split('/start ')[1]):
         # Send a welcome message that the user has come via referral link
-        me = await bot.get_me()
+        me = await get_bot_me(bot)
         personal_link = f"https://t.me/{me.username}?start={message.from_user.id}"
         
         welcome_text = (
@@ -307,7 +354,7 @@ async def start_with_referer(message, bot, state, text):
 
 # Function to start without referral link
 async def start_without_referer(message, bot, state):
-    me = await bot.get_me()
+    me = await get_bot_me(bot)
     personal_link = f"https://t.me/{me.username}?start={message.from_user.id}"
     
     welcome_text = (
@@ -333,33 +380,90 @@ async def start_without_referer(message, bot, state):
                                reply_markup=keyboard.as_markup())
 
 
-# Function to check if the URL is a bot link
-def is_bot_link(url):
-    bot_link_pattern = re.compile(r'\?start=')
-    return bool(bot_link_pattern.search(url))
-
-
-# Function to check subscription to all sponsor channels
-async def check_all_subs(bot, user_id, channels_list):
+# Function to check one sponsor channel, a failed or slow lookup does not block the user
+async def check_channel_sub(bot, user_id, channel_info):
     try:
-        for channel_info in channels_list:
-            if is_bot_link(channel_info['url']):
-                return True
-            user_channel_status = await bot.get_chat_member(chat_id=channel_info['channel_id'], user_id=user_id)
-            if user_channel_status.status not in ['administrator', 'owner', 'member', 'creator']:
-                return False
-        return True
-    except:
+        user_channel_status = await asyncio.wait_for(
+            bot.get_chat_member(chat_id=channel_info['channel_id'], user_id=user_id), timeout=SUB_CHECK_TIMEOUT)
+    except Exception:
         print(traceback.format_exc())
-        return True
+        # Unknown result: let the user through, but do not cache it
+        return None
+    return user_channel_status.status in MEMBER_STATUSES
+
+
+def sub_cache_key(user_id, channel_id):
+    return f"sub_{user_id}_{channel_id}"
+
+
+# Function to check subscription to all sponsor channels concurrently
+async def check_subs(bot, user_id, channels_list, fresh: bool = False):
+    """
+    Возвращает вердикты {channel_id: True/False/None}.
+    Вердикты берутся из общего кэша в Redis; остальные каналы проверяются параллельно,
+    после первого False оставшиеся проверки отменяются и остаются None.
+    fresh=True игнорирует кэш (пользователь нажал "Проверить подписку")
+    """
+    verdicts = {channel['channel_id']: None for channel in channels_list}
+    # Subscription to a bot cannot be checked
+    to_check = [channel for channel in channels_list if not channel['is_bot_link']]
+    for channel in channels_list:
+        if channel['is_bot_link']:
+            verdicts[channel['channel_id']] = True
+
+    if not fresh and to_check:
+        cached = await redis_cache.get_many([sub_cache_key(user_id, channel['channel_id']) for channel in to_check])
+        for channel, verdict in zip(to_check, cached):
+            if verdict is not None:
+                verdicts[channel['channel_id']] = bool(verdict)
+        if False in verdicts.values():
+            return verdicts
+        to_check = [channel for channel in to_check if verdicts[channel['channel_id']] is None]
+
+    tasks = {asyncio.create_task(check_channel_sub(bot, user_id, channel)): channel['channel_id']
+             for channel in to_check}
+    pending = set(tasks)
+    positive, negative = {}, {}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            channel_id = tasks[task]
+            result = task.result()
+            verdicts[channel_id] = True if result is None else result
+            if result is True:
+                positive[sub_cache_key(user_id, channel_id)] = 1
+            elif result is False:
+                negative[sub_cache_key(user_id, channel_id)] = 0
+        if False in verdicts.values():
+            for task in pending:
+                task.cancel()
+            break
+
+    # Positive verdicts live longer than negative ones, so a new subscription is noticed quickly
+    await redis_cache.set_many(positive, SUB_CACHE_TTL)
+    await redis_cache.set_many(negative, SUB_CACHE_NEGATIVE_TTL)
+    return verdicts
+
+
+# Function to detect a tap on the "check subscription" button of the subscribe prompt
+def is_subscription_recheck(callback_query):
+    markup = callback_query.message.reply_markup if callback_query.message else None
+    if not markup:
+        return False
+    return any(button.text == SUB_CHECK_BUTTON_TEXT and button.callback_data == callback_query.data
+               for row in markup.inline_keyboard for button in row)
+
+
+# Function to select channels to show in the subscribe prompt
+def missing_channels(channels_list, verdicts):
+    # Unchecked channels and bot links are shown too, since they are not confirmed
+    return [channel for channel in channels_list
+            if not verdicts.get(channel['channel_id']) or channel['is_bot_link']]
 
 
 # Function to handle case when user is not subscribed
 async def not_subscribe(bot, user_id, channels_list, callback, message_id):
-    markup = InlineKeyboardBuilder()
-    for channel in channels_list:
-        markup.row(InlineKeyboardButton(text=channel['name'], url=channel['url'].replace(';', ':')))
-    markup.row(InlineKeyboardButton(text='✅ Проверить подписку', callback_data=callback))
+    markup = channel_registry.subscribe_markup(channels_list, callback)
     try:
         if message_id is not None:
             await bot.edit_message_caption(chat_id=user_id, message_id=message_id,
@@ -377,82 +481,49 @@ async def not_subscribe(bot, user_id, channels_list, callback, message_id):
 
 # Function to increment subscription count for sponsor channels
 async def plus_sub(channels_list, db, user_id):
-    import time
     start_time = time.time()
-    
-    # Подготовим bulk операции для обновления каналов
-    bulk_operations = []
-    
-    for channel in channels_list:
-        # Используем update_one с upsert=False и применяем операции атомарно
-        update_operation = {
-            'filter': {'channel_id': channel['channel_id']},
-            'update': {
-                '$inc': {'subs': 1},  # Увеличиваем счетчик подписчиков
-                '$addToSet': {'subscribed_users': user_id} # Добавляем пользователя в список, если его там еще нет
-            }
-        }
-        bulk_operations.append(update_operation)
-    
-    # Выполняем bulk операции
-    for operation in bulk_operations:
-        await db.channels.update_one(operation['filter'], operation['update'])
-    
+
+    # Пары канал-пользователь, уже записанные этим процессом, повторно не отправляем
+    channel_ids = [channel['channel_id'] for channel in channels_list
+                   if (channel['channel_id'], user_id) not in known_members]
+    if not channel_ids:
+        return
+
+    # Членство хранится в channel_members с уникальным индексом (channel_id, user_id):
+    # upsert вставляет документ только при первом засчитывании
+    now = int(time.time())
+    bulk_operations = [
+        UpdateOne({'channel_id': channel_id, 'user_id': user_id}, {'$setOnInsert': {'joined_at': now}}, upsert=True)
+        for channel_id in channel_ids
+    ]
+    try:
+        result = await db.channel_members.bulk_write(bulk_operations)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        # Параллельный запрос уже вставил часть пар - они не считаются новыми
+        upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+
+    # subs увеличивается только для каналов, где пользователь засчитан впервые
+    # Счетчик subs не влияет на список каналов, поэтому кэши не сбрасываем
+    await db.channels.bulk_write([UpdateOne({'channel_id': channel_ids[index]}, {'$inc': {'subs': 1}})
+                                  for index in upserted], invalidate=False)
+    for channel_id in channel_ids:
+        known_members[(channel_id, user_id)] = None
+
     # Логируем операцию
-    perf_logger.log_db_operation("plus_sub_bulk_update", "channels", time.time() - start_time, len(bulk_operations))
+    perf_logger.log_db_operation("plus_sub_bulk_update", "channel_members", time.time() - start_time)
 
 
 # Function to show advertisement to user
 async def adv_show(user_id, bot, db):
+    # Частоту показов проверяем до любых запросов к базе и Bot API
+    if not adv_cap.allow(int(user_id)):
+        return
     start_time = time.time()
     
-    # Используем Redis кэш для хранения adv_id пользователя
-    from src.utils.redis_cache import RedisCache
-    cache = RedisCache()
-    
-    # Попробуем получить adv_id из кэша
-    cached_adv_id = await cache.get(f"user_adv_id_{user_id}")
-    
-    if cached_adv_id is not None:
-        adv_user_shows = cached_adv_id
-    else:
-        # Если в кэше нет, получаем из базы данных
-        user_query = await db.users.find_one({'id': int(user_id)})
-        if not user_query:
-            perf_logger.log_db_operation("find_one", "users", time.time() - start_time, success=False)
-            return # Если пользователь не найден, выходим
-        
-        adv_user_shows = int(user_query.adv_id)
-        # Сохраняем в кэш на 1 час
-        await cache.set(f"user_adv_id_{user_id}", adv_user_shows, 3600)
-    
-    # Получаем рекламный пост из базы данных
-    adv_start_time = time.time()
-    if adv_user_shows != 1:
-        adv_query = await db.adv.find_one({'adv_id': adv_user_shows})
-    else:
-        adv_query = await db.adv.find_one_with_min_adv_id()
-    
-    perf_logger.log_db_operation("find_one/find_one_with_min_adv_id", "adv", time.time() - adv_start_time)
-    
+    # Пост по указателю ротации пользователя в Redis, без запросов к базе
+    adv_query = await next_user_adv(db, user_id)
     if adv_query:
-        # Получаем следующий рекламный пост
-        next_adv_start_time = time.time()
-        next_adv_query = await db.adv.find_one_with_next_adv_id(adv_query.adv_id)
-        perf_logger.log_db_operation("find_one_with_next_adv_id", "adv", time.time() - next_adv_start_time)
-        
-        if next_adv_query:
-            new_adv_id = int(next_adv_query.adv_id)
-        else:
-            new_adv_id = 1  # Если следующего поста нет, возвращаемся к первому
-        
-        # Обновляем adv_id пользователя в базе данных и в кэше
-        update_start_time = time.time()
-        await db.users.update_one({'id': int(user_id)}, {'adv_id': new_adv_id})
-        perf_logger.log_db_operation("update_one", "users", time.time() - update_start_time)
-        
-        await cache.set(f"user_adv_id_{user_id}", new_adv_id, 3600)
-        
         kwargs = {'caption': adv_query.caption} if adv_query.caption else {}
         if adv_query.content_type == 'photo':
             await bot.send_photo(user_id, photo=adv_query.content, **kwargs, parse_mode='html')
@@ -462,6 +533,12 @@ async def adv_show(user_id, bot, db):
             await bot.send_document(user_id, document=adv_query.content, **kwargs, parse_mode='html')
         elif adv_query.content_type == 'text':
             await bot.send_message(user_id, text=adv_query.content, parse_mode='html')
+        else:
+            return
+        # Показ засчитывается только после успешной отправки: в лимит частоты
+        # и в памяти для adv_stats (запишется пачкой)
+        adv_cap.record(int(user_id))
+        count_adv_impression(adv_query.adv_id)
     
     perf_logger.log_db_operation("adv_show_total", "performance", time.time() - start_time)
 
@@ -471,55 +548,35 @@ async def show_advert(user_id: int):
     ...
 
 
-def get_referral_id_from_env():
+def track_referral_usage(referrer_id: int, user_info: dict, message_content: str = None, is_message: bool = False,
+                         is_click: bool = False):
     """
-    Получает реф ID из переменной окружения
+    Учитывает событие пользователя, который перешел по реф ссылке:
+    обновляет его привязку к ссылке (одна запись на пару), почасовые и дневные рулапы
+    и, выборочно, пишет событие в сырой журнал.
+    Все записи идут через буферы, вызывающий базу не ждет
     """
-    # Получаем основной реф ID
-    referral_ids = []
-    main_referral_id = os.getenv("REFERRAL_ID")
-    if main_referral_id:
-        referral_ids.append(int(main_referral_id))
-    
-    # Проверяем дополнительные реф ID (до 10)
-    for i in range(2, 11):
-        additional_referral_id = os.getenv(f"REFERRAL_ID_{i}")
-        if additional_referral_id:
-            referral_ids.append(int(additional_referral_id))
-        else:
-            # Если переменная не установлена, прерываем цикл
-            break
-    
-    return referral_ids
-
-
-async def track_referral_usage(referrer_id: int, user_info: dict, message_content: str = None):
-    """
-    Создает запись о пользователе, который перешел по реф ссылке
-    """
-    # Логируем информацию для отладки
-    print(f"Tracking referral usage: referrer_id={referrer_id}, user_id={user_info['id']}, message_content={message_content}")
-    
-    referral_tracking = ReferralTracking(
-        id=str(uuid.uuid4()),
-        referrer_id=referrer_id,
-        user_id=user_info['id'],
-        user_username=user_info.get('username'),
-        user_first_name=user_info['first_name'],
-        user_last_name=user_info.get('last_name'),
-        message_content=message_content,
-        timestamp=int(datetime.utcnow().timestamp())
-    )
-    
-    # Сохраняем в базу данных
-    from src.utils.db import db  # Импорт в глобальной области видимости для избежания циклических зависимостей
-    try:
-        result = await db.referral_tracking.insert_one(referral_tracking.dict())
-        print(f"Referral tracking record inserted with ID: {result.inserted_id}")
-    except Exception as e:
-        print(f"Error inserting referral tracking record: {e}")
-    
-    return referral_tracking
+    now = int(time.time())
+    referral_attribution.record(referrer_id, user_info, now, messages=1 if is_message else 0)
+    referral_rollups.record('referrer', referrer_id, user_info['id'], clicks=1 if is_click else 0,
+                            messages=1 if is_message else 0, timestamp=now)
+    if REFERRAL_LOG_SAMPLE_RATE and random.random() < REFERRAL_LOG_SAMPLE_RATE:
+        referral_events.add(ReferralTracking(
+            id=str(uuid.uuid4()),
+            referrer_id=referrer_id,
+            user_id=user_info['id'],
+            user_username=user_info.get('username'),
+            user_first_name=user_info['first_name'],
+            user_last_name=user_info.get('last_name'),
+            message_content=message_content,
+            timestamp=now
+        ).model_dump())
+
+
+def track_link_message(user):
+    """Засчитывает сообщение пользователя реф ссылке, по которой он пришел впервые (рулапы по ссылкам)"""
+    if user is not None and user.ref_link:
+        referral_rollups.record('link', user.ref_link, user.id, messages=1)
 
 
 async def save_referral_message(referrer_id: int, sender_id: int, message: Message):
@@ -535,4 +592,4 @@ async def save_referral_message(referrer_id: int, sender_id: int, message: Messa
     
     message_content = message.text or message.caption or None
     
-    await track_referral_usage(referrer_id, user_info, message_content)
+    track_referral_usage(referrer_id, user_info, message_content, is_message=True)
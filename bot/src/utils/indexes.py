@@ -0,0 +1,120 @@
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger('indexes')
+
+# Индексы для коллекций MongoDbClient: имя коллекции в db -> список индексов
+INDEXES = {
+    'users': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+    ],
+    'channels': [
+        IndexModel([('channel_id', ASCENDING)], name='channel_id_unique', unique=True),
+    ],
+    'channel_members': [
+        IndexModel([('channel_id', ASCENDING), ('user_id', ASCENDING)], name='channel_id_user_id_unique', unique=True),
+    ],
+    'referrals': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+    ],
+    'adv': [
+        IndexModel([('adv_id', ASCENDING)], name='adv_id_unique', unique=True),
+    ],
+    'adv_stats': [
+        IndexModel([('adv_id', ASCENDING), ('day', ASCENDING)], name='adv_id_day_unique', unique=True),
+    ],
+    'referral_tracking': [
+        IndexModel([('referrer_id', ASCENDING), ('timestamp', DESCENDING)], name='referrer_id_timestamp'),
+        IndexModel([('user_id', ASCENDING), ('referrer_id', ASCENDING)], name='user_id_referrer_id'),
+    ],
+    'counters': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+    ],
+    'referral_attribution': [
+        IndexModel([('referrer_id', ASCENDING), ('user_id', ASCENDING)], name='referrer_id_user_id_unique',
+                   unique=True),
+        IndexModel([('referrer_id', ASCENDING), ('first_seen', DESCENDING)], name='referrer_id_first_seen'),
+    ],
+    'referral_rollup_hourly': [
+        IndexModel([('kind', ASCENDING), ('ref', ASCENDING), ('bucket', ASCENDING)], name='kind_ref_bucket_unique',
+                   unique=True),
+        IndexModel([('bucket', ASCENDING)], name='bucket'),
+    ],
+    'referral_rollup_daily': [
+        IndexModel([('kind', ASCENDING), ('ref', ASCENDING), ('bucket', ASCENDING)], name='kind_ref_bucket_unique',
+                   unique=True),
+        IndexModel([('bucket', ASCENDING)], name='bucket'),
+    ],
+    'referral_rollup_users': [
+        IndexModel([('granularity', ASCENDING), ('kind', ASCENDING), ('ref', ASCENDING), ('bucket', ASCENDING),
+                    ('user_id', ASCENDING)], name='granularity_kind_ref_bucket_user_id_unique', unique=True),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'settings': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+    ],
+    'mailings': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('status', ASCENDING), ('created_at', DESCENDING)], name='status_created_at'),
+    ],
+}
+
+
+def _options(info: dict) -> dict:
+    # Сравниваем только опции, влияющие на поведение индекса
+    return {'unique': bool(info.get('unique', False)), 'sparse': bool(info.get('sparse', False)),
+            'expireAfterSeconds': info.get('expireAfterSeconds')}
+
+
+def _same_except_ttl(current: dict, spec: dict) -> bool:
+    # Отличается только TTL, и в новой спецификации он задан
+    if spec.get('expireAfterSeconds') is None:
+        return False
+    return {**_options(current), 'expireAfterSeconds': None} == {**_options(spec), 'expireAfterSeconds': None}
+
+
+async def ensure_indexes(db) -> dict:
+    """
+    Создает недостающие индексы. У существующих индексов меняет на месте только TTL (collMod);
+    если отличаются unique/sparse, индекс не трогается и попадает в mismatch - его нужно пересоздать вручную
+    (автоматический drop оставил бы коллекцию без индекса, если новый не построится, например из-за дубликатов).
+    Возвращает отчет {'ok': [...], 'created': [...], 'modified': [...], 'mismatch': [...], 'failed': [...]}
+    """
+    report = {'ok': [], 'created': [], 'modified': [], 'mismatch': [], 'failed': []}
+    for collection_name, indexes in INDEXES.items():
+        collection = getattr(db, collection_name).collection
+        existing = await collection.index_information()
+        for index in indexes:
+            spec = index.document
+            key = list(spec['key'].items())
+            label = f"{collection_name}.{spec['name']}"
+            # Ищем индекс по тем же полям, даже если он был создан под другим именем
+            current_name, current = next(((name, info) for name, info in existing.items() if info['key'] == key),
+                                         (None, None))
+            try:
+                if current is None:
+                    await collection.create_indexes([index])
+                    report['created'].append(label)
+                elif _options(current) == _options(spec):
+                    report['ok'].append(label)
+                elif _same_except_ttl(current, spec):
+                    # TTL меняется без пересоздания индекса
+                    await collection.database.command('collMod', collection.name, index={
+                        'name': current_name, 'expireAfterSeconds': spec['expireAfterSeconds']})
+                    report['modified'].append(label)
+                else:
+                    log.warning(f'Index {label} exists as {current_name} with options {_options(current)}, '
+                                f'expected {_options(spec)}; rebuild it manually')
+                    report['mismatch'].append(label)
+            except OperationFailure as e:
+                # Например, уникальный индекс не строится из-за дубликатов в коллекции
+                log.error(f'Failed to build index {label}: {e}')
+                report['failed'].append(label)
+
+    for status in ('created', 'modified', 'failed'):
+        if report[status]:
+            log.info(f'Indexes {status}: {", ".join(report[status])}')
+    log.info(f'Indexes up to date: {len(report["ok"])}')
+    return report
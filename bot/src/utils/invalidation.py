@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+from src.utils.redis_cache import redis_cache
+
+log = logging.getLogger('invalidation')
+
+# Канал Redis, через который процессы бота сообщают друг другу об изменениях
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "cache_invalidation")
+# Пауза перед переподключением подписчика после ошибки: удваивается до RECONNECT_MAX_DELAY (в секундах)
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+
+class InvalidationBus:
+    """
+    Шина инвалидации поверх Redis pub/sub.
+    publish(entity, keys) сбрасывает локальные кэши сущности и рассылает событие остальным процессам;
+    каждый процесс слушает канал и вызывает обработчики, подписанные на entity.
+    keys=None означает "сбросить все записи сущности"
+    """
+    def __init__(self, channel: str = INVALIDATION_CHANNEL):
+        self.channel = channel
+        # Свои сообщения процесс пропускает - локально они уже обработаны
+        self.instance_id = uuid.uuid4().hex
+        self.handlers = {}
+        self.task = None
+        # Подписчик подключен к Redis (до первой ошибки считаем, что да);
+        # без подключения события другим процессам не отправляются
+        self.connected = True
+        self._sending = set()
+
+    def subscribe(self, entity: str, handler):
+        """Зарегистрировать обработчик handler(keys) для событий сущности entity"""
+        self.handlers.setdefault(entity, []).append(handler)
+
+    def dispatch(self, entity: str, keys: list = None):
+        for handler in self.handlers.get(entity, ()):
+            try:
+                handler(keys)
+            except Exception as e:
+                log.error(f'Invalidation handler for {entity} failed: {e}')
+
+    def publish(self, entity: str, keys: list = None, local: bool = True):
+        """
+        Сообщить об изменении записей keys сущности entity.
+        local=False - только другим процессам (если локальный кэш уже актуален)
+        """
+        if local:
+            self.dispatch(entity, keys)
+        if not self.connected:
+            # Redis недоступен - отправка все равно не пройдет; после переподключения
+            # процессы сбрасывают кэши целиком (см. _listen)
+            return
+        message = json.dumps({'src': self.instance_id, 'entity': entity, 'keys': keys})
+        # Отправка не задерживает запись, которая ее вызвала
+        task = asyncio.get_running_loop().create_task(self._send(message))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, message: str):
+        try:
+            await redis_cache.client.publish(self.channel, message)
+        except Exception as e:
+            log.warning(f'Failed to publish invalidation: {e}')
+
+    def _handle(self, data: str):
+        try:
+            event = json.loads(data)
+        except ValueError:
+            return
+        if event.get('src') == self.instance_id:
+            return
+        self.dispatch(event['entity'], event.get('keys'))
+
+    async def _listen(self):
+        connected_before = False
+        delay = RECONNECT_DELAY
+        while True:
+            pubsub = redis_cache.client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self.connected = True
+                delay = RECONNECT_DELAY
+                if connected_before:
+                    # Пока подписки не было, события могли потеряться (в том числе наши, которые не отправлялись) -
+                    # сбрасываем все у себя и просим остальные процессы сделать то же
+                    log.info('Invalidation subscriber reconnected')
+                    for entity in list(self.handlers):
+                        self.publish(entity)
+                connected_before = True
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message['type'] == 'message':
+                        self._handle(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.connected:
+                    log.warning(f'Invalidation subscriber disconnected: {e}')
+                else:
+                    log.debug(f'Invalidation subscriber reconnect failed, next attempt in {delay}s: {e}')
+                self.connected = False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                # Пока подключения нет, наши события не отправляются - после него сбрасываем все
+                connected_before = True
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._listen())
+
+    async def close(self):
+        """Остановить подписчика и дождаться отправки событий (при остановке бота)"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.connected = False
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+
+
+# Глобальная шина инвалидации процесса
+invalidation_bus = InvalidationBus()
@@ -1,44 +1,144 @@
-import redis
+import asyncio
 import json
+import logging
 import os
-from typing import Optional, Any
+from typing import Optional, Any, List, Dict
+
+import redis.asyncio as redis
+
+log = logging.getLogger('redis_cache')
+
+# Значения больше этого размера (в байтах) декодируются в отдельном потоке, чтобы не блокировать event loop
+JSON_OFFLOAD_SIZE = 64 * 1024
+# Коллекции длиннее этого числа элементов кодируются в отдельном потоке
+JSON_OFFLOAD_ITEMS = 1000
+
+
+async def _dumps(value: Any) -> str:
+    if isinstance(value, (list, dict, tuple, set)) and len(value) > JSON_OFFLOAD_ITEMS:
+        return await asyncio.to_thread(json.dumps, value)
+    return json.dumps(value)
+
+
+async def _loads(value: str) -> Any:
+    if len(value) > JSON_OFFLOAD_SIZE:
+        return await asyncio.to_thread(json.loads, value)
+    return json.loads(value)
 
 
 class RedisCache:
-    def __init__(self):
+    def __init__(self, redis_url: str = None):
         # Используем переменную окружения для подключения к Redis
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-        self.redis_client = redis.from_url(redis_url, decode_responses=True)
-        
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379")
+        self.pool = None
+        self.redis_client = None
+
+    def connect(self) -> redis.Redis:
+        """Создает общий для процесса пул соединений (один раз)"""
+        if self.redis_client is None:
+            self.pool = redis.ConnectionPool.from_url(
+                self.redis_url, decode_responses=True,
+                max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+                socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.5)),
+                socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", 1)))
+            self.redis_client = redis.Redis(connection_pool=self.pool)
+        return self.redis_client
+
+    @property
+    def client(self) -> redis.Redis:
+        return self.connect()
+
+    async def close(self):
+        """Закрыть пул соединений (при остановке бота)"""
+        if self.redis_client is not None:
+            await self.redis_client.aclose()
+            await self.pool.disconnect()
+            self.redis_client = None
+            self.pool = None
+
+    def pipeline(self, transaction: bool = False):
+        """Pipeline для пакетной отправки команд за один round trip"""
+        return self.client.pipeline(transaction=transaction)
+
     async def get(self, key: str) -> Optional[Any]:
         """Получить значение из кэша"""
         try:
-            value = self.redis_client.get(key)
+            value = await self.client.get(key)
             if value:
-                return json.loads(value)
+                return await _loads(value)
             return None
         except Exception:
             return None
-    
+
     async def set(self, key: str, value: Any, expire: int = 3600) -> bool:
         """Установить значение в кэш с временем жизни (в секундах)"""
         try:
-            self.redis_client.setex(key, expire, json.dumps(value))
+            await self.client.setex(key, expire, await _dumps(value))
             return True
         except Exception:
             return False
-    
+
     async def delete(self, key: str) -> bool:
         """Удалить значение из кэша"""
         try:
-            self.redis_client.delete(key)
+            await self.client.delete(key)
             return True
         except Exception:
             return False
-    
+
     async def exists(self, key: str) -> bool:
         """Проверить, существует ли ключ в кэше"""
         try:
-            return bool(self.redis_client.exists(key))
+            return bool(await self.client.exists(key))
         except Exception:
-            return False
\ No newline at end of file
+            return False
+
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Получить несколько значений одним запросом (MGET)"""
+        if not keys:
+            return []
+        try:
+            values = await self.client.mget(keys)
+            return [await _loads(value) if value is not None else None for value in values]
+        except Exception:
+            return [None] * len(keys)
+
+    async def set_many(self, values: Dict[str, Any], expire: int = 3600) -> bool:
+        """Установить несколько значений с одним временем жизни через pipeline"""
+        if not values:
+            return True
+        try:
+            pipe = self.pipeline()
+            for key, value in values.items():
+                pipe.setex(key, expire, await _dumps(value))
+            await pipe.execute()
+            return True
+        except Exception:
+            return False
+
+    async def delete_many(self, keys: List[str]) -> bool:
+        """Удалить несколько ключей одним запросом"""
+        if not keys:
+            return True
+        try:
+            await self.client.delete(*keys)
+            return True
+        except Exception:
+            return False
+
+
+# Глобальный экземпляр кэша
+redis_cache = RedisCache()
+
+
+async def init_redis() -> bool:
+    """
+    Подключение к Redis при старте: создает пул и проверяет доступность сервера
+    """
+    try:
+        await redis_cache.connect().ping()
+        return True
+    except Exception as e:
+        # Бот работает и без Redis, просто без кэша
+        log.warning(f'Redis is not available: {e}')
+        return False
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+from types import MappingProxyType
+
+from src.utils.invalidation import invalidation_bus
+from src.utils.snapshot import Snapshot
+
+log = logging.getLogger('referrals')
+
+# Документ в коллекции settings со списком реф ID:
+# {'id': 'referral_routing', 'referrers': [{'id': 123, 'name': '...'}, ...]}
+ROUTING_SETTINGS_ID = 'referral_routing'
+# Как часто перечитывать документ, если его изменили в базе в обход бота (в секундах)
+ROUTING_REFRESH_INTERVAL = float(os.getenv("REFERRAL_ROUTING_REFRESH", 60))
+
+
+class ReferralRoutes:
+    """
+    Неизменяемая таблица реф ID: frozenset для проверки за O(1),
+    порядок для обхода и метаданные каждого реферера
+    """
+    def __init__(self, referrers: list, source: str):
+        # Порядок сохраняется, повторы отбрасываются
+        ordered = {}
+        for referrer in referrers:
+            ordered.setdefault(int(referrer['id']), MappingProxyType({**referrer, 'id': int(referrer['id'])}))
+        self.ordered = tuple(ordered)
+        self.ids = frozenset(ordered)
+        self.meta = MappingProxyType(ordered)
+        self.source = source
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.ids
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def match_link(self, payload: str):
+        """Реф ID из параметра /start, если он есть в таблице, иначе None"""
+        if payload.isdigit() and int(payload) in self.ids:
+            return int(payload)
+        return None
+
+
+def routes_from_env() -> ReferralRoutes:
+    """Реф ID из REFERRAL_ID и REFERRAL_ID_2 ... REFERRAL_ID_10 (до первого пропуска)"""
+    referrers = []
+    main_referral_id = os.getenv("REFERRAL_ID")
+    if main_referral_id:
+        referrers.append({'id': int(main_referral_id)})
+    for i in range(2, 11):
+        additional_referral_id = os.getenv(f"REFERRAL_ID_{i}")
+        if not additional_referral_id:
+            break
+        referrers.append({'id': int(additional_referral_id)})
+    return ReferralRoutes(referrers, source='env')
+
+
+class ReferralRouter:
+    """
+    Текущая таблица реф ID процесса. Переменные окружения читаются один раз при старте,
+    документ настроек из базы (если есть) заменяет их и перечитывается без перезапуска:
+    сразу при изменении через бота (шина инвалидации) и раз в ROUTING_REFRESH_INTERVAL секунд
+    """
+    def __init__(self):
+        self.env_routes = routes_from_env()
+        self.routes = self.env_routes
+        self.db = None
+        self.task = None
+        self._reloads = set()
+        invalidation_bus.subscribe('settings', self._on_invalidation)
+
+    async def load(self, db) -> ReferralRoutes:
+        self.db = db
+        try:
+            settings = await db.settings.find_one({'id': ROUTING_SETTINGS_ID}, raw=True)
+            if settings and settings.get('referrers') is not None:
+                routes = ReferralRoutes(settings['referrers'], source='db')
+            else:
+                routes = self.env_routes
+        except Exception as e:
+            # Документ правится вручную: при ошибке в нем продолжаем работать с текущей таблицей
+            log.error(f'Failed to load referral routing: {e!r}')
+            return self.routes
+        if routes.ids != self.routes.ids:
+            log.info(f'Referral routing ({routes.source}): {list(routes)}')
+        # Одно присваивание: обработчики видят либо старую, либо новую таблицу целиком
+        self.routes = routes
+        return routes
+
+    def _on_invalidation(self, keys):
+        if self.db is None or (keys is not None and ROUTING_SETTINGS_ID not in keys):
+            return
+        task = asyncio.get_running_loop().create_task(self.load(self.db))
+        self._reloads.add(task)
+        task.add_done_callback(self._reloads.discard)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(ROUTING_REFRESH_INTERVAL)
+            try:
+                await self.load(self.db)
+            except Exception as e:
+                log.error(f'Referral routing refresh failed: {e}')
+
+    async def start(self, db):
+        """Загрузить таблицу и периодически перечитывать ее"""
+        await self.load(db)
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+referral_router = ReferralRouter()
+
+
+class ReferralLinks(Snapshot):
+    """
+    Множество id реф ссылок (коллекция referrals) в памяти процесса.
+    Сбрасывается при добавлении или удалении ссылки в любом процессе (шина инвалидации)
+    """
+    def __init__(self):
+        super().__init__('referrals')
+
+    async def _load(self, db) -> frozenset:
+        referrals = await db.referrals.find({}, count=None, projection={'id': 1, '_id': 0}, raw=True)
+        return frozenset(referral['id'] for referral in referrals)
+
+
+referral_links = ReferralLinks()
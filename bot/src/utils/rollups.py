@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from cachetools import TTLCache
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.utils.db import db
+from src.utils.flusher import PeriodicFlusher
+
+log = logging.getLogger('rollups')
+
+# Формат bucket и сколько хранить отметки уникальных пользователей для каждой гранулярности
+GRANULARITIES = {
+    'hour': ('%Y-%m-%dT%H', timedelta(hours=2)),
+    'day': ('%Y-%m-%d', timedelta(days=2)),
+}
+COUNTERS = ('clicks', 'messages')
+
+
+def bucket(granularity: str, timestamp: float = None) -> str:
+    return time.strftime(GRANULARITIES[granularity][0], time.gmtime(timestamp))
+
+
+class ReferralRollups(PeriodicFlusher):
+    """
+    Почасовые и дневные счетчики по реф ссылкам и реферерам: клики, уникальные пользователи, сообщения.
+    События копятся в памяти и раз в flush_interval секунд добавляются к документам рулапов через $inc.
+    Уникальные пользователи считаются через отметки в referral_rollup_users:
+    uniques растет только если отметка пары (bucket, пользователь) вставлена впервые
+    """
+    def __init__(self, collections: dict, users_collection, flush_interval: float = 10):
+        super().__init__(flush_interval)
+        self.collections = collections
+        self.users_collection = users_collection
+        self.pending_users = set()
+        # Отметки, уже записанные этим процессом, повторно не отправляем
+        self.seen_users = TTLCache(maxsize=200_000, ttl=3600)
+
+    def record(self, kind: str, ref, user_id: int, clicks: int = 0, messages: int = 0, timestamp: float = None):
+        """Учесть событие пользователя user_id по ссылке или рефереру ref"""
+        timestamp = timestamp or time.time()
+        for granularity in GRANULARITIES:
+            key = (granularity, kind, str(ref), bucket(granularity, timestamp))
+            counters = self.pending.setdefault(key, {'clicks': 0, 'messages': 0, 'uniques': 0})
+            counters['clicks'] += clicks
+            counters['messages'] += messages
+            marker = key + (int(user_id),)
+            if marker not in self.seen_users:
+                self.pending_users.add(marker)
+
+    async def _count_uniques(self, markers: list, pending: dict):
+        # Вставляем отметки; новые пользователи увеличивают uniques своего bucket
+        now = datetime.now(timezone.utc)
+        requests = [UpdateOne({'granularity': granularity, 'kind': kind, 'ref': ref, 'bucket': bucket_,
+                               'user_id': user_id},
+                              {'$setOnInsert': {'expires_at': now + GRANULARITIES[granularity][1]}}, upsert=True)
+                    for granularity, kind, ref, bucket_, user_id in markers]
+        try:
+            result = await self.users_collection.bulk_write(requests, invalidate=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as e:
+            # Дубликаты - пользователь уже посчитан другим процессом
+            upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+        for index in upserted:
+            pending.setdefault(markers[index][:4], {'clicks': 0, 'messages': 0, 'uniques': 0})['uniques'] += 1
+        for marker in markers:
+            self.seen_users[marker] = None
+
+    def _merge(self, key, counters: dict):
+        # Складываем с событиями, пришедшими за время записи
+        current = self.pending.setdefault(key, {'clicks': 0, 'messages': 0, 'uniques': 0})
+        for name, value in counters.items():
+            current[name] += value
+
+    def _has_pending(self) -> bool:
+        return bool(self.pending or self.pending_users)
+
+    def _take(self) -> tuple:
+        pending, self.pending = self.pending, {}
+        markers, self.pending_users = list(self.pending_users), set()
+        return pending, markers
+
+    async def _write_rollup(self, collection, pending: dict, keys: list):
+        # $inc счетчиков рулапа; записанные ключи убираются из pending
+        requests = [UpdateOne({'kind': key[1], 'ref': key[2], 'bucket': key[3]}, {'$inc': pending[key]}, upsert=True)
+                    for key in keys]
+        failed = set()
+        try:
+            await collection.bulk_write(requests, invalidate=False)
+        except BulkWriteError as e:
+            # Например, одновременная вставка того же bucket другим процессом - повторим в следующий раз
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        for index, key in enumerate(keys):
+            if index not in failed:
+                del pending[key]
+
+    async def _write(self, taken: tuple):
+        pending, markers = taken
+        try:
+            if markers:
+                await self._count_uniques(markers, pending)
+                markers = []
+            for granularity, collection in self.collections.items():
+                keys = [key for key in pending if key[0] == granularity]
+                if keys:
+                    await self._write_rollup(collection, pending, keys)
+        except Exception as e:
+            log.error(f'Failed to flush referral rollups: {e}')
+        # Записанные ключи уже убраны из pending, остальное возвращаем в буфер
+        self._requeue(pending)
+        self.pending_users.update(markers)
+
+    async def report(self, granularity: str, since: str) -> list:
+        """Документы рулапа гранулярности granularity начиная с bucket since (только рулапы, без сырых событий)"""
+        return await self.collections[granularity].find({'bucket': {'$gte': since}}, count=10_000,
+                                                        sort=[('bucket', 1)])
+
+
+referral_rollups = ReferralRollups(
+    {'hour': db.referral_rollup_hourly, 'day': db.referral_rollup_daily}, db.referral_rollup_users,
+    flush_interval=float(os.getenv("REFERRAL_ROLLUP_FLUSH_INTERVAL", 10)),
+)
@@ -0,0 +1,42 @@
+import asyncio
+
+from src.utils.invalidation import invalidation_bus
+
+
+class Snapshot:
+    """
+    Данные в памяти процесса, загружаемые из базы при первом обращении и после каждого сброса.
+    Подкласс реализует только _load(db). entity - сущность шины инвалидации, события которой сбрасывают снимок.
+    Если снимок сбросили во время загрузки, загруженное значение могло устареть:
+    вызывающий его получает, но следующий get загрузит данные заново
+    """
+    def __init__(self, entity: str = None):
+        self.value = None
+        self.generation = 0
+        self.lock = asyncio.Lock()
+        if entity:
+            invalidation_bus.subscribe(entity, lambda keys: self.invalidate())
+
+    async def _load(self, db):
+        raise NotImplementedError
+
+    async def load(self, db):
+        generation = self.generation
+        value = await self._load(db)
+        if self.generation == generation:
+            self.value = value
+        return value
+
+    async def get(self, db):
+        """Текущий снимок; к базе обращается только после сброса"""
+        value = self.value
+        if value is None:
+            async with self.lock:
+                value = self.value
+                if value is None:
+                    value = await self.load(db)
+        return value
+
+    def invalidate(self):
+        self.generation += 1
+        self.value = None
@@ -0,0 +1,145 @@
+import logging
+import os
+from collections import deque
+
+from pymongo import UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
+
+from src.utils.db import db
+from src.utils.flusher import PeriodicFlusher
+
+log = logging.getLogger('tracking')
+
+# Что делать, если в буфере уже max_pending событий:
+# drop_oldest - вытеснять самые старые, drop_newest - отбрасывать новые
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest')
+
+
+class InsertBuffer(PeriodicFlusher):
+    """
+    Буфер вставок: документы копятся в памяти и записываются одним неупорядоченным insert_many
+    по таймеру или при накоплении batch_size документов. Вызывающий никогда не ждет базу
+    """
+    def __init__(self, collection, batch_size: int = 500, flush_interval: float = 2, max_pending: int = 10_000,
+                 overflow: str = 'drop_oldest', write_concern: WriteConcern = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}')
+        super().__init__(flush_interval, max_pending)
+        self.collection = collection
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.write_concern = write_concern
+        self.dropped = 0
+
+    def _empty(self):
+        return deque()
+
+    def _take(self) -> list:
+        # Одна пачка из начала очереди
+        return [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def add(self, document: dict) -> bool:
+        """Поставить документ в очередь на запись; False, если он отброшен"""
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                log.warning(f'{self.collection.collection.name} buffer is full, {self.dropped} events dropped so far')
+            if self.overflow == 'drop_newest':
+                return False
+            self.pending.popleft()
+        self.pending.append(document)
+        if len(self.pending) >= self.batch_size:
+            self.flush_soon()
+        return True
+
+    async def _write(self, batch: list):
+        try:
+            await self.collection.insert_many(batch, ordered=False, write_concern=self.write_concern)
+        except Exception as e:
+            # Недописанные документы теряются: повтор мог бы задублировать уже вставленные
+            log.error(f'Failed to insert {len(batch)} documents into {self.collection.collection.name}: {e}')
+
+    async def flush(self):
+        """Записать накопленные документы пачками по batch_size"""
+        async with self.lock:
+            while self.pending:
+                await self._write(self._take())
+
+
+class AttributionBuffer(PeriodicFlusher):
+    """
+    Буфер привязок к реф ссылкам: события по одной паре (referrer_id, user_id) объединяются в памяти
+    и записываются одним bulk_write upsert'ов по уникальному индексу пары
+    """
+    def __init__(self, collection, flush_interval: float = 5, max_pending: int = 5000):
+        super().__init__(flush_interval, max_pending)
+        self.collection = collection
+
+    def record(self, referrer_id: int, user_info: dict, timestamp: int, messages: int = 0):
+        """Учесть событие пользователя user_info по ссылке referrer_id"""
+        key = (int(referrer_id), int(user_info['id']))
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = {'first_seen': timestamp, 'last_seen': timestamp, 'messages': 0}
+        entry['first_seen'] = min(entry['first_seen'], timestamp)
+        entry['last_seen'] = max(entry['last_seen'], timestamp)
+        entry['messages'] += messages
+        entry['profile'] = {'user_username': user_info.get('username'),
+                            'user_first_name': user_info.get('first_name'),
+                            'user_last_name': user_info.get('last_name')}
+        if len(self.pending) >= self.max_pending:
+            self.flush_soon()
+
+    def _merge(self, key, entry: dict):
+        # Вернуть неудавшуюся запись в буфер, объединив с событиями, пришедшими за время записи
+        current = self.pending.get(key)
+        if current is None:
+            self.pending[key] = entry
+            return
+        current['first_seen'] = min(current['first_seen'], entry['first_seen'])
+        current['last_seen'] = max(current['last_seen'], entry['last_seen'])
+        current['messages'] += entry['messages']
+
+    async def _write(self, pending: dict):
+        keys = list(pending)
+        requests = []
+        for referrer_id, user_id in keys:
+            entry = pending[(referrer_id, user_id)]
+            requests.append(UpdateOne({'referrer_id': referrer_id, 'user_id': user_id}, {
+                '$min': {'first_seen': entry['first_seen']},
+                '$max': {'last_seen': entry['last_seen']},
+                '$inc': {'messages': entry['messages']},
+                '$set': entry['profile'],
+            }, upsert=True))
+        try:
+            await self.collection.bulk_write(requests, invalidate=False)
+        except BulkWriteError as e:
+            # Остальные операции применены; повторяем только упавшие
+            # (например, дубликат ключа при одновременной вставке пары из другого процесса)
+            self._requeue(pending, [keys[error['index']] for error in e.details.get('writeErrors', [])])
+        except Exception as e:
+            log.error(f'Failed to flush {len(requests)} referral attributions: {e}')
+            self._requeue(pending)
+
+
+# Привязки пользователей к реф ссылкам
+referral_attribution = AttributionBuffer(
+    db.referral_attribution,
+    flush_interval=float(os.getenv("REFERRAL_ATTRIBUTION_FLUSH_INTERVAL", 5)),
+    max_pending=int(os.getenv("REFERRAL_ATTRIBUTION_MAX_PENDING", 5000)),
+)
+
+# Доля событий, которые дополнительно пишутся в сырой журнал referral_tracking.
+# По умолчанию пишутся все: только журнал хранит текст сообщений (message_content); 0 - журнал выключен
+REFERRAL_LOG_SAMPLE_RATE = float(os.getenv("REFERRAL_LOG_SAMPLE_RATE", 1))
+
+# Сырой журнал событий по реф ссылкам (выборка REFERRAL_LOG_SAMPLE_RATE).
+# По умолчанию запись без подтверждения (w=0): потеря единичных событий допустима, задержка - нет
+referral_events = InsertBuffer(
+    db.referral_tracking,
+    batch_size=int(os.getenv("REFERRAL_TRACKING_BATCH", 500)),
+    flush_interval=float(os.getenv("REFERRAL_TRACKING_FLUSH_INTERVAL", 2)),
+    max_pending=int(os.getenv("REFERRAL_TRACKING_MAX_PENDING", 10_000)),
+    overflow=os.getenv("REFERRAL_TRACKING_OVERFLOW", "drop_oldest"),
+    write_concern=WriteConcern(w=int(os.getenv("REFERRAL_TRACKING_W", 0))),
+)
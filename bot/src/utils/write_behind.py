@@ -0,0 +1,55 @@
+import logging
+import os
+
+from pymongo import UpdateOne
+
+from src.utils.db import db
+from src.utils.flusher import PeriodicFlusher
+
+log = logging.getLogger('write_behind')
+
+
+class WriteBehindBuffer(PeriodicFlusher):
+    """
+    Буфер отложенной записи: изменения полей документа копятся в памяти,
+    объединяются по ключу и сбрасываются в базу одним bulk_write
+    по таймеру или при достижении max_pending ключей
+    """
+    def __init__(self, collection, key_field: str = 'id', flush_interval: float = 5, max_pending: int = 500):
+        super().__init__(flush_interval, max_pending)
+        self.collection = collection
+        self.key_field = key_field
+
+    def set(self, key, fields: dict):
+        """Запланировать $set полей fields для документа с ключом key"""
+        self.pending.setdefault(key, {}).update(fields)
+        # Закэшированная модель сразу получает новые значения, чтобы чтения их видели до записи в базу
+        cache = self.collection.cache
+        model = cache.get(key) if cache is not None else None
+        if model is not None:
+            for name, value in fields.items():
+                if name in model.model_fields:
+                    setattr(model, name, value)
+        if len(self.pending) >= self.max_pending:
+            self.flush_soon()
+
+    def _merge(self, key, fields: dict):
+        # Не затираем более свежие изменения, пришедшие за время записи
+        self.pending[key] = {**fields, **self.pending.get(key, {})}
+
+    async def _write(self, pending: dict):
+        requests = [UpdateOne({self.key_field: key}, {'$set': fields}) for key, fields in pending.items()]
+        try:
+            # Кэш уже содержит эти значения, поэтому не сбрасываем его
+            await self.collection.bulk_write(requests, invalidate=False)
+        except Exception as e:
+            log.error(f'Failed to flush {len(requests)} updates: {e}')
+            self._requeue(pending)
+            return
+        # Остальные процессы перечитают эти документы из базы
+        self.collection.publish_invalidation(list(pending), local=False)
+
+
+# Обновления профилей и флагов пользователей
+user_updates = WriteBehindBuffer(db.users, flush_interval=float(os.getenv("USER_FLUSH_INTERVAL", 5)),
+                                 max_pending=int(os.getenv("USER_FLUSH_SIZE", 500)))